@@ -1,8 +1,43 @@
 import os
 import json
+import sys
 from collections import Counter
 
+from run_store import breakdown, open_store, samples
+
+def print_summary(total_failed, error_counts):
+    print(f"Total failed records: {total_failed}")
+    print("\nError types and counts:")
+    for error, count in error_counts:
+        print(f"- {error}: {count}")
+
+    # Calculate percentages
+    print("\nError percentages:")
+    for error, count in error_counts:
+        percentage = (count / total_failed) * 100
+        print(f"- {error}: {percentage:.2f}%")
+
+def analyze_failed_outcomes(conn, status):
+    # Failed and unprocessed users are grouped by error class in the outcome database
+    error_counts = breakdown(conn, status, 'error_class')
+    print_summary(sum(count for _, count in error_counts), error_counts)
+
+    print("\nSample of failed records per error (up to 5):")
+    for error, _ in error_counts:
+        print(f"\n{error}:")
+        for outcome in samples(conn, status, 'error_class', error):
+            print(f"- User ID: {outcome['local_id']}")
+            print(f"  Error: {outcome['error']}")
+            print(f"  Email: {outcome['email'] or 'N/A'}")
+            print(f"  HTTP status: {outcome['http_status'] or 'N/A'}, latency: {outcome['latency'] or 0:.3f}s, thread: {outcome['thread']}")
+
 def analyze_failed_records(folder_path):
+    conn = open_store(folder_path)
+    if conn:
+        analyze_failed_outcomes(conn, 'failed')
+        conn.close()
+        return
+
     failed_records = []
     error_counts = Counter()
 
@@ -18,17 +53,7 @@ def analyze_failed_records(folder_path):
                         error_counts[record['error']] += 1
 
     # Generate summary
-    total_failed = len(failed_records)
-    print(f"Total failed records: {total_failed}")
-    print("\nError types and counts:")
-    for error, count in error_counts.most_common():
-        print(f"- {error}: {count}")
-
-    # Calculate percentages
-    print("\nError percentages:")
-    for error, count in error_counts.most_common():
-        percentage = (count / total_failed) * 100
-        print(f"- {error}: {percentage:.2f}%")
+    print_summary(len(failed_records), error_counts.most_common())
 
     # Sample of failed records
     print("\nSample of failed records (up to 5):")
@@ -39,5 +64,5 @@ def analyze_failed_records(folder_path):
         print()
 
 if __name__ == "__main__":
-    folder_path = input("Enter the folder path containing the failed records files: ")
+    folder_path = sys.argv[1] if len(sys.argv) > 1 else input("Enter the folder path containing the failed records files: ")
     analyze_failed_records(folder_path)
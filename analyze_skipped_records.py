@@ -1,22 +1,52 @@
 import json
+import os
+import sys
 from collections import Counter
 
-def read_json_file(file_path):
-    with open(file_path, 'r') as file:
-        return json.load(file)
+from run_store import breakdown, open_store, samples
+from user_stream import iter_users
+
+def analyze_skipped_outcomes(folder_path):
+    # Users skipped by a migration run are grouped by kind and by reason in its outcome database
+    conn = open_store(folder_path)
+    if not conn:
+        print(f"No outcome database in {folder_path}")
+        return
+    kind_counts = breakdown(conn, 'skipped', 'kind')
+    reason_counts = breakdown(conn, 'skipped', 'error_class')
+    total_records = sum(count for _, count in kind_counts)
+
+    print(f"Total skipped users: {total_records}")
+    print("\nKinds of skipped users:")
+    for kind, count in kind_counts:
+        percentage = (count / total_records) * 100
+        print(f"- {kind}: {count} ({percentage:.2f}%)")
+
+    print("\nReasons for skipping:")
+    for reason, count in reason_counts:
+        percentage = (count / total_records) * 100
+        print(f"- {reason or 'Unknown'}: {count} ({percentage:.2f}%)")
+
+    print("\nSample users for each reason:")
+    for reason, _ in reason_counts:
+        print(f"\n{reason or 'Unknown'}:")
+        for outcome in samples(conn, 'skipped', 'error_class', reason):
+            print(f"- User ID: {outcome['local_id']}, Kind: {outcome['kind']}, Email: {outcome['email'] or 'N/A'}")
+    conn.close()
 
 def analyze_skipped_records(file_path):
-    skipped_records = read_json_file(file_path)
-    
-    total_records = len(skipped_records)
+    # Stream the records once, keeping the first record seen for each reason as its sample
+    total_records = 0
     reason_counter = Counter()
-    
-    for record in skipped_records:
+    samples = {}
+
+    for record in iter_users(file_path):
+        total_records += 1
         reasons = record.get('reasons', {})
-        if reasons == 'N.A.':
-            reason_counter['Unknown'] += 1
-        else:
-            reason_counter.update(reasons.keys())
+        reasons = ['Unknown'] if reasons == 'N.A.' else list(reasons.keys())
+        reason_counter.update(reasons)
+        for reason in reasons:
+            samples.setdefault(reason, record)
     
     print(f"Total skipped records: {total_records}")
     print("\nReasons for skipping:")
@@ -26,15 +56,15 @@ def analyze_skipped_records(file_path):
     
     print("\nSample records for each reason:")
     for reason in reason_counter.keys():
-        if reason == 'Unknown':
-            sample = next((r for r in skipped_records if r.get('reasons') == 'N.A.'), None)
-        else:
-            sample = next((r for r in skipped_records if reason in r.get('reasons', {})), None)
-        
+        sample = samples.get(reason)
         if sample:
             print(f"\n{reason}:")
             print(json.dumps(sample, indent=2))
 
 if __name__ == "__main__":
-    skipped_records_file = 'skipped_records.json'
-    analyze_skipped_records(skipped_records_file)
+    # A logs folder reports on the run's skipped users, a file on split-records.py output
+    skipped_records_file = sys.argv[1] if len(sys.argv) > 1 else 'skipped_records.ndjson'
+    if os.path.isdir(skipped_records_file):
+        analyze_skipped_outcomes(skipped_records_file)
+    else:
+        analyze_skipped_records(skipped_records_file)
@@ -0,0 +1,318 @@
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Admin API routes served by the mock, matched against the request path
+TOKEN_PATH = re.compile(r'^/realms/[^/]+/protocol/openid-connect/token$')
+USERS_PATH = re.compile(r'^/admin/realms/[^/]+/users$')
+COUNT_PATH = re.compile(r'^/admin/realms/[^/]+/users/count$')
+USER_PATH = re.compile(r'^/admin/realms/[^/]+/users/([^/]+)$')
+IDENTITIES_PATH = re.compile(r'^/admin/realms/[^/]+/users/([^/]+)/federated-identity$')
+IDENTITY_PATH = re.compile(r'^/admin/realms/[^/]+/users/([^/]+)/federated-identity/([^/]+)$')
+IMPORT_PATH = re.compile(r'^/admin/realms/[^/]+/partialImport$')
+
+
+def make_token(ttl):
+    '''
+    Unsigned JWT whose only claim is its expiry, enough for the migration's token refresh
+    '''
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f'{encode({"alg": "none"})}.{encode({"exp": time.time() + ttl})}.mock'
+
+
+def token_expired(token):
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp'] < time.time()
+    except Exception:
+        # Static admin tokens are accepted as is
+        return False
+
+
+class Realm:
+    '''
+    In-memory users of the mock realm, unique by username and email like Keycloak
+    '''
+    def __init__(self):
+        self.users = {}
+        self.usernames = set()
+        self.emails = set()
+        # userId attribute -> Keycloak id, for `q=userId:...` searches
+        self.user_ids = {}
+        self.lock = threading.Lock()
+
+    def add(self, user):
+        '''
+        Store a user representation, returning its id or None when it already exists
+        '''
+        username = user.get('username')
+        email = (user.get('email') or '').lower() or None
+        with self.lock:
+            if username in self.usernames or (email and email in self.emails):
+                return None
+            user_id = str(uuid.uuid4())
+            # Keycloak stores every attribute as a list of values
+            attributes = {key: value if isinstance(value, list) else [value]
+                          for key, value in (user.get('attributes') or {}).items() if value is not None}
+            user = dict(user, id=user_id, attributes=attributes)
+            self.users[user_id] = user
+            self.usernames.add(username)
+            if email:
+                self.emails.add(email)
+            for firebase_id in attributes.get('userId', []):
+                self.user_ids[firebase_id] = user_id
+            return user_id
+
+    def update(self, user_id, changes):
+        with self.lock:
+            if user_id not in self.users:
+                return False
+            user = self.users[user_id]
+            email = (changes.get('email') or '').lower()
+            if email and email != (user.get('email') or '').lower():
+                if email in self.emails:
+                    return None
+                self.emails.discard((user.get('email') or '').lower())
+                self.emails.add(email)
+            user.update(changes)
+            return True
+
+    def link(self, user_id, provider, identity):
+        with self.lock:
+            if user_id not in self.users:
+                return False
+            identities = self.users[user_id].setdefault('federatedIdentities', [])
+            if not any(linked['identityProvider'] == provider for linked in identities):
+                identities.append(dict(identity, identityProvider=provider))
+            return True
+
+    def identities(self, user_id):
+        with self.lock:
+            if user_id not in self.users:
+                return None
+            return list(self.users[user_id].get('federatedIdentities') or [])
+
+    def page(self, first, count, query=None):
+        with self.lock:
+            if query:
+                # Only the userId attribute is searchable in the mock
+                key, _, value = query.partition(':')
+                user_id = self.user_ids.get(value) if key == 'userId' else None
+                users = [self.users[user_id]] if user_id else []
+            else:
+                users = list(self.users.values())
+        return [representation(user) for user in users[first:first + count]]
+
+
+def representation(user):
+    '''
+    User as returned by Keycloak's user endpoints, without credentials or federated identities
+    '''
+    return {key: value for key, value in user.items() if key not in ('credentials', 'federatedIdentities')}
+
+
+class MockKeycloak(ThreadingHTTPServer):
+    '''
+    Stand-in for the Keycloak token and admin endpoints used by the migration, with
+    configurable latency, injected 409/429/5xx responses and a limit on concurrent requests
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, MockHandler)
+        self.config = config
+        self.realm = Realm()
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'created': 0, 'conflicts': 0, 'injected_409': 0, 'injected_429': 0,
+                      'injected_5xx': 0, 'rejected_over_limit': 0, 'identities_linked': 0, 'tokens': 0,
+                      'expired_tokens': 0, 'max_in_flight': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=()):
+        data = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def handle_request(self, method):
+        server = self.server
+        config = server.config
+        url = urlparse(self.path)
+        body = self.read_body()
+
+        if url.path == '/mock/stats':
+            with server.stats_lock:
+                stats = dict(server.stats, users=len(server.realm.users))
+            return self.reply(200, stats)
+        if TOKEN_PATH.match(url.path):
+            server.count('tokens')
+            return self.reply(200, {'access_token': make_token(config.token_ttl), 'expires_in': config.token_ttl})
+
+        server.count('requests')
+        with server.stats_lock:
+            if config.max_in_flight and server.in_flight >= config.max_in_flight:
+                server.stats['rejected_over_limit'] += 1
+                over_limit = True
+            else:
+                server.in_flight += 1
+                server.stats['max_in_flight'] = max(server.stats['max_in_flight'], server.in_flight)
+                over_limit = False
+        if over_limit:
+            return self.reply(503, {'error': 'Too many concurrent requests'})
+        try:
+            self.handle_admin(method, url, body)
+        finally:
+            with server.stats_lock:
+                server.in_flight -= 1
+
+    def handle_admin(self, method, url, body):
+        server = self.server
+        config = server.config
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        if token_expired(token):
+            server.count('expired_tokens')
+            return self.reply(401, {'error': 'HTTP 401 Unauthorized'})
+
+        time.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+        roll = random.random()
+        if roll < config.rate_429:
+            server.count('injected_429')
+            return self.reply(429, {'error': 'Too many requests'})
+        if roll < config.rate_429 + config.rate_5xx:
+            server.count('injected_5xx')
+            return self.reply(503, {'error': 'Service unavailable'})
+
+        path = url.path
+        if method == 'POST' and USERS_PATH.match(path):
+            return self.create_user(json.loads(body))
+        if method == 'GET' and COUNT_PATH.match(path):
+            return self.reply(200, len(server.realm.users))
+        if method == 'GET' and USERS_PATH.match(path):
+            query = parse_qs(url.query)
+            first = int(query.get('first', ['0'])[0])
+            count = int(query.get('max', ['100'])[0])
+            return self.reply(200, server.realm.page(first, count, query.get('q', [None])[0]))
+        match = IDENTITIES_PATH.match(path)
+        if method == 'GET' and match:
+            identities = server.realm.identities(match.group(1))
+            return self.reply(200, identities) if identities is not None else self.reply(404, {'error': 'User not found'})
+        match = IDENTITY_PATH.match(path)
+        if method == 'POST' and match:
+            if not server.realm.link(match.group(1), match.group(2), json.loads(body or b'{}')):
+                return self.reply(404, {'error': 'User not found'})
+            server.count('identities_linked')
+            return self.reply(204)
+        match = USER_PATH.match(path)
+        if method == 'PUT' and match:
+            updated = server.realm.update(match.group(1), json.loads(body))
+            if updated is None:
+                return self.reply(409, {'errorMessage': 'User exists with same email'})
+            return self.reply(204) if updated else self.reply(404, {'error': 'User not found'})
+        if method == 'GET' and match:
+            user = server.realm.users.get(match.group(1))
+            return self.reply(200, representation(user)) if user else self.reply(404, {'error': 'User not found'})
+        if method == 'POST' and IMPORT_PATH.match(path):
+            return self.partial_import(json.loads(body))
+        self.reply(404, {'error': 'Not found'})
+
+    def create_user(self, user):
+        server = self.server
+        config = server.config
+        if config.reject_embedded_identities and 'federatedIdentities' in user:
+            return self.reply(400, {'errorMessage': 'Unrecognized field "federatedIdentities"'})
+        if random.random() < config.rate_409:
+            server.count('injected_409')
+            return self.reply(409, {'errorMessage': 'User exists with same username'})
+        user_id = server.realm.add(user)
+        if user_id is None:
+            server.count('conflicts')
+            return self.reply(409, {'errorMessage': 'User exists with same username or email'})
+        server.count('created')
+        server.count('identities_linked', len(user.get('federatedIdentities') or []))
+        location = f'http://{self.headers.get("Host")}{self.path}/{user_id}'
+        self.reply(201, headers=[('Location', location)])
+
+    def partial_import(self, data):
+        server = self.server
+        results = []
+        added = skipped = 0
+        for user in data.get('users', []):
+            user_id = server.realm.add(user)
+            if user_id:
+                added += 1
+                server.count('created')
+                server.count('identities_linked', len(user.get('federatedIdentities') or []))
+            else:
+                skipped += 1
+                server.count('conflicts')
+            results.append({'action': 'ADDED' if user_id else 'SKIPPED', 'resourceType': 'USER',
+                            'resourceName': user.get('username'), 'id': user_id})
+        self.reply(200, {'added': added, 'skipped': skipped, 'overwritten': 0, 'results': results})
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Keycloak admin API used by create-users.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8180)
+    parser.add_argument('--latency', type=float, default=0.01, help='Mean seconds added to every admin request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the added latency')
+    parser.add_argument('--rate-409', type=float, default=0.0, help='Fraction of creates answered 409 Conflict')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of admin requests answered 429')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='Fraction of admin requests answered 503')
+    parser.add_argument('--max-in-flight', type=int, default=0, help='Answer 503 beyond this many concurrent admin requests')
+    parser.add_argument('--token-ttl', type=int, default=300, help='Lifetime of issued admin tokens in seconds')
+    parser.add_argument('--reject-embedded-identities', action='store_true',
+                        help='Answer 400 to creates carrying federatedIdentities, like Keycloak versions without support')
+    return parser
+
+
+def main():
+    config = build_parser().parse_args()
+    server = MockKeycloak((config.host, config.port), config)
+    print(f'Mock Keycloak listening on http://{config.host}:{config.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Default share of each kind of Firebase user in synthetic dumps
+DEFAULT_MIX = 'phone=0.35,email-password=0.3,provider=0.25,email=0.05,invalid=0.05'
+
+# Environment of create-users.py per benchmark mode
+MODES = {
+    'threads': {'ENGINE': 'threads'},
+    'async': {'ENGINE': 'async'},
+    'bulk': {'ENGINE': 'threads', 'BULK_IMPORT': 'true'},
+}
+
+
+def parse_mix(mix):
+    kinds = {}
+    for part in mix.split(','):
+        kind, _, share = part.partition('=')
+        kinds[kind.strip()] = float(share)
+    return kinds
+
+
+def synthetic_user(index, kind):
+    '''
+    Firebase export record of the given kind
+    '''
+    user = {'localId': f'user{index:09d}', 'displayName': f'Bench User{index}', 'createdAt': str(1600000000000 + index)}
+    if kind == 'phone':
+        user['phoneNumber'] = f'+9198{index:08d}'
+    elif kind == 'email-password':
+        user.update(email=f'user{index}@example.com', emailVerified=True,
+                    passwordHash='aGFzaGVkLXBhc3N3b3Jk', salt='c2FsdA==')
+    elif kind == 'provider':
+        user.update(email=f'user{index}@gmail.com', emailVerified=True, providerUserInfo=[
+            {'providerId': 'google.com', 'rawId': str(100000000000 + index), 'email': f'user{index}@gmail.com'},
+        ])
+    elif kind == 'email':
+        user.update(email=f'user{index}@example.org', emailVerified=True)
+    return user
+
+
+def write_dump(file_path, num_users, mix, seed=0):
+    '''
+    Write a Firebase export with `num_users` users drawn from the `mix` of kinds
+    '''
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    with open(file_path, 'w') as f:
+        f.write('{"users": [\n')
+        for index in range(num_users):
+            kind = rng.choices(kinds, weights)[0]
+            f.write(('' if index == 0 else ',\n') + json.dumps(synthetic_user(index, kind)))
+        f.write('\n]}\n')
+
+
+def start_mock(args, port):
+    command = [
+        sys.executable, os.path.join(BENCHMARK_DIR, 'mock_keycloak.py'), '--port', str(port),
+        '--latency', str(args.latency), '--jitter', str(args.jitter), '--rate-409', str(args.rate_409),
+        '--rate-429', str(args.rate_429), '--rate-5xx', str(args.rate_5xx),
+        '--max-in-flight', str(args.max_in_flight), '--token-ttl', str(args.token_ttl),
+    ]
+    mock = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # Wait until the mock accepts requests
+    for _ in range(100):
+        try:
+            urlopen(f'http://127.0.0.1:{port}/mock/stats', timeout=1).read()
+            return mock
+        except OSError:
+            time.sleep(0.1)
+    mock.kill()
+    raise RuntimeError('Mock Keycloak did not start')
+
+
+def run_migration(dump_file, mode, threads, port, work_dir):
+    '''
+    Run create-users.py once against the mock, returning its output, wall time and peak RSS in MB
+    '''
+    env = dict(os.environ, **MODES[mode])
+    env.update({
+        'KEYCLOAK_URL': f'http://127.0.0.1:{port}',
+        'REALM_NAME': 'benchmark',
+        'CLIENT_ID': 'benchmark',
+        'CLIENT_SECRET': 'benchmark',
+        'USER_DUMP_FILE': dump_file,
+        'NUM_USERS_TO_PROCESS': '0',
+        'NUM_THREADS': str(threads),
+        'MAX_IN_FLIGHT': str(threads),
+        'LOG_FILE_PATH': os.path.join(work_dir, f'{mode}_{threads}_'),
+        'PROGRESS_INTERVAL': '3600',
+    })
+    output_path = os.path.join(work_dir, f'{mode}_{threads}.out')
+    start_time = time.time()
+    with open(output_path, 'w') as output:
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'create-users.py')],
+                                   env=env, cwd=REPO_DIR, stdout=output, stderr=subprocess.STDOUT)
+        # wait4 reports the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.time() - start_time
+    with open(output_path) as f:
+        text = f.read()
+    if status:
+        print(text[-2000:])
+        raise RuntimeError(f'create-users.py failed in {mode} mode with {threads} threads')
+    return text, wall_time, usage.ru_maxrss / 1024
+
+
+def parse_output(text):
+    '''
+    Pick the figures the benchmark reports out of the create-users.py summary
+    '''
+    result = {}
+    latency = re.search(r'Request latency: p50 ([\d.]+)s, p95 ([\d.]+)s, p99 ([\d.]+)s', text)
+    if latency:
+        result['p50'], result['p95'], result['p99'] = (float(value) for value in latency.groups())
+    throughput = re.search(r'Throughput: ([\d.]+) users/sec', text)
+    if throughput:
+        result['users_per_sec'] = float(throughput.group(1))
+    requests = re.search(r'Requests: (\d+), retries: (\d+)', text)
+    if requests:
+        result['requests'], result['retries'] = int(requests.group(1)), int(requests.group(2))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark create-users.py against a local mock Keycloak')
+    parser.add_argument('--users', type=int, default=5000, help='Users in the synthetic dump')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Share of each user kind, e.g. phone=0.5,email-password=0.5')
+    parser.add_argument('--dump', help='Use this dump instead of generating one')
+    parser.add_argument('--threads', default='1,4,16', help='Comma-separated thread (or in-flight) counts')
+    parser.add_argument('--modes', default='threads,bulk', help=f'Comma-separated modes out of {", ".join(MODES)}')
+    parser.add_argument('--port', type=int, default=8180)
+    parser.add_argument('--latency', type=float, default=0.01, help='Mean seconds added by the mock to every request')
+    parser.add_argument('--jitter', type=float, default=0.002)
+    parser.add_argument('--rate-409', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-5xx', type=float, default=0.0)
+    parser.add_argument('--max-in-flight', type=int, default=0)
+    parser.add_argument('--token-ttl', type=int, default=300)
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='fb2kc-benchmark-')
+    dump_file = args.dump
+    if not dump_file:
+        dump_file = os.path.join(work_dir, 'users.json')
+        write_dump(dump_file, args.users, parse_mix(args.mix))
+    print(f'Dump: {dump_file}, work folder: {work_dir}')
+
+    results = []
+    header = f'{"mode":<8} {"threads":>7} {"users/sec":>10} {"p50 s":>8} {"p95 s":>8} {"p99 s":>8} {"requests":>9} {"retries":>8} {"created":>8} {"peak MB":>8}'
+    print(header)
+    for mode in args.modes.split(','):
+        for threads in (int(value) for value in args.threads.split(',')):
+            # Fresh realm for every run so earlier runs cause no conflicts
+            mock = start_mock(args, args.port)
+            try:
+                text, wall_time, peak_rss = run_migration(dump_file, mode, threads, args.port, work_dir)
+                stats = json.loads(urlopen(f'http://127.0.0.1:{args.port}/mock/stats').read())
+            finally:
+                mock.terminate()
+                mock.wait()
+            result = dict(parse_output(text), mode=mode, threads=threads, wall_time=wall_time,
+                          peak_rss_mb=peak_rss, mock=stats)
+            results.append(result)
+            print(f'{mode:<8} {threads:>7} {result.get("users_per_sec", 0):>10.1f} {result.get("p50", 0):>8.3f} '
+                  f'{result.get("p95", 0):>8.3f} {result.get("p99", 0):>8.3f} {result.get("requests", 0):>9} '
+                  f'{result.get("retries", 0):>8} {stats["created"]:>8} {peak_rss:>8.1f}', flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
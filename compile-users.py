@@ -0,0 +1,73 @@
+import argparse, dotenv, itertools, multiprocessing, os, time
+from collections import Counter
+
+from user_payloads import classify_user, compile_user
+from user_stream import bounded_imap, iter_chunks, iter_users
+
+# Load environment variables
+dotenv.load_dotenv()
+
+# Records sent to a worker process at a time
+CHUNK_SIZE = 1000
+
+def compile_chunk(users):
+    '''
+    Compile a chunk of users, returning the NDJSON lines and a count per user kind
+    '''
+    lines = []
+    kinds = Counter()
+    for user in users:
+        lines.append(compile_user(user))
+        kinds[classify_user(user)] += 1
+    return ''.join(lines), kinds
+
+def compile_users(user_dump, output_folder, num_processes, num_shards, limit):
+    '''
+    Stream the dump once and write ready-to-send Keycloak payloads to `num_shards`
+    NDJSON files, transforming chunks of users in `num_processes` worker processes
+    '''
+    start_time = time.time()
+    os.makedirs(output_folder, exist_ok=True)
+    shards = [open(os.path.join(output_folder, f'payloads_{i + 1}.ndjson'), 'w') for i in range(num_shards)]
+
+    users = iter_users(user_dump)
+    if limit:
+        users = itertools.islice(users, limit)
+    chunks = iter_chunks(users, CHUNK_SIZE)
+
+    kinds = Counter()
+    try:
+        if num_processes > 1:
+            with multiprocessing.Pool(num_processes) as pool:
+                results = bounded_imap(pool, compile_chunk, chunks, num_processes * 2)
+                for i, (lines, chunk_kinds) in enumerate(results):
+                    shards[i % num_shards].write(lines)
+                    kinds.update(chunk_kinds)
+        else:
+            for i, chunk in enumerate(chunks):
+                lines, chunk_kinds = compile_chunk(chunk)
+                shards[i % num_shards].write(lines)
+                kinds.update(chunk_kinds)
+    finally:
+        for shard in shards:
+            shard.close()
+
+    total = sum(kinds.values())
+    total_time = time.time() - start_time
+    print(f'Compiled {total} users into {num_shards} shards in {output_folder}')
+    for kind, count in kinds.most_common():
+        print(f'- {kind}: {count}')
+    print(f'Total time taken: {total_time:.2f} seconds ({total / total_time if total_time else 0:.2f} users/sec)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a Firebase user dump into ready-to-send Keycloak payloads')
+    parser.add_argument('--dump', default=os.getenv('USER_DUMP_FILE'), help='Firebase user dump (default: USER_DUMP_FILE)')
+    parser.add_argument('--output', default='compiled', help='Folder for the payload shards')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes transforming users')
+    parser.add_argument('--shards', type=int, default=1, help='Number of payload files to write')
+    parser.add_argument('--limit', type=int, default=0, help='Compile only the first LIMIT users')
+    args = parser.parse_args()
+    compile_users(args.dump, args.output, args.processes, args.shards, args.limit)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,22 @@
-import dotenv, json, logging, os, requests, threading, time, uuid
-from datetime import datetime
+import argparse, asyncio, collections, dotenv, itertools, json, logging, multiprocessing, os, queue, threading, time, uuid
+from datetime import datetime, timedelta
+from urllib.parse import quote
 
-import re
+from delta_sync import CHANGED, UNCHANGED, DeltaSync
+from dump_index import open_index
+from metrics import Metrics
+from preflight import Preflight
+from run_logging import LogWriter, QueueLogHandler, UserContextFilter, current_user_id, redact
+from scheduling import SCHEDULES, TIER_NAMES, Scheduler
+from run_store import OutcomeSender, RunStore, ids_with_status, open_store
+from keycloak_client import AdaptiveController, admin_get, connection_stats, create_session, create_token_manager, iter_user_pages
+from user_payloads import (
+    EMAIL_PASSWORD_USER, EMAIL_USER, INVALID_USER, PHONE_USER, PROVIDER_USER, SKIPPED_KINDS, SKIPPED_PROVIDER_USER,
+    build_email_user_data, build_federated_identities, build_phone_number_user_data,
+    build_provider_user_data, build_user_data, classify_user, compile_record, fingerprint, parse_compiled, with_identities,
+)
+from user_stream import iter_shard, iter_users, worker_of, write_record
+from user_validation import validate_record
 
 # Load environment variables
 dotenv.load_dotenv()
@@ -11,72 +26,241 @@ KEYCLOAK_URL = os.getenv('KEYCLOAK_URL')
 REALM_NAME = os.getenv('REALM_NAME')
 NUM_THREADS = int(os.getenv('NUM_THREADS', '1'))  # Default to 1 thread if not provided
 NUM_USERS_TO_PROCESS = int(os.getenv('NUM_USERS_TO_PROCESS', '100'))  # Default to process 100 users if not provided
+QUEUE_SIZE = int(os.getenv('QUEUE_SIZE', '100'))  # Records buffered per thread while streaming the dump
+BULK_IMPORT = os.getenv('BULK_IMPORT', 'false').lower() == 'true'  # Create users in batches via partialImport
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', '500'))  # Users per partialImport request
+BULK_IF_EXISTS = os.getenv('BULK_IF_EXISTS', 'SKIP').upper()  # partialImport policy for existing users: SKIP, OVERWRITE or FAIL
+ENGINE = os.getenv('ENGINE', 'threads').lower()  # 'threads' or 'async'
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))  # Processes each running the engine with its own connections
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', '200'))  # Concurrent requests for the async engine
+INITIAL_CONCURRENCY = int(os.getenv('INITIAL_CONCURRENCY', '8'))  # In-flight requests at start, adjusted up to NUM_THREADS/MAX_IN_FLIGHT
+LATENCY_TARGET = float(os.getenv('LATENCY_TARGET', '2.0'))  # Seconds; slower responses reduce concurrency
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '5'))  # Retries for 429/5xx responses and connection errors
+BACKOFF_BASE = float(os.getenv('BACKOFF_BASE', '0.5'))  # Seconds; first retry waits up to twice this
+BACKOFF_MAX = float(os.getenv('BACKOFF_MAX', '30'))  # Seconds; upper bound of a single retry wait
+TOKEN_REFRESH_MARGIN = float(os.getenv('TOKEN_REFRESH_MARGIN', '60'))  # Seconds before expiry to refresh the admin token
+EMBED_IDENTITIES = os.getenv('EMBED_IDENTITIES', 'true').lower() == 'true'  # Link Google identities in the create request itself
+LOG_MODE = os.getenv('LOG_MODE', 'file').lower()  # 'file' (text log per thread) or 'queue' (one background writer)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()  # DEBUG adds per-record banners, WARNING keeps only problems
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '10'))  # Seconds between progress lines and metrics file updates
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Serve Prometheus metrics on this port, if set
+PREFLIGHT = os.getenv('PREFLIGHT', 'false').lower() == 'true'  # Find duplicates and existing Keycloak users before sending
+PREFLIGHT_PAGE_SIZE = int(os.getenv('PREFLIGHT_PAGE_SIZE', '1000'))  # Keycloak users per page while indexing the realm
+PREFLIGHT_WORKERS = int(os.getenv('PREFLIGHT_WORKERS', '4'))  # Pages of Keycloak users fetched concurrently
+SCHEDULE = os.getenv('SCHEDULE', 'dump').lower()  # 'dump' order, most recent 'activity' first, or activity 'tiers' in turn
+SCHEDULE_BUFFER = int(os.getenv('SCHEDULE_BUFFER', '100000'))  # Users sorted in memory before spilling to SCHEDULE_TMP_DIR
+SCHEDULE_TMP_DIR = os.getenv('SCHEDULE_TMP_DIR')  # Folder for spilled users (default: the system temp folder)
+ACTIVE_DAYS = int(os.getenv('ACTIVE_DAYS', '30'))  # Users signed in within this many days form the 'active' tier
+RECENT_DAYS = int(os.getenv('RECENT_DAYS', '365'))  # ... and within this many days the 'recent' tier, the rest are 'dormant'
+DUMP_INDEX_FILE = os.getenv('DUMP_INDEX_FILE')  # Byte-offset index of the dump for --retry (default: <USER_DUMP_FILE>.index.db)
+# (connect, read) timeouts in seconds for Keycloak requests
+REQUEST_TIMEOUT = (float(os.getenv('CONNECT_TIMEOUT', '10')), float(os.getenv('READ_TIMEOUT', '60')))
 
-def get_admin_token():
+# Static admin token, used as is when no CLIENT_ID/CLIENT_SECRET are configured
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Response fields used by the async engine, named like requests' Response
+AsyncResponse = collections.namedtuple('AsyncResponse', ['status_code', 'text', 'headers', 'elapsed'])
+
+# Error message prefix per user kind, matching the UserProcessor messages
+CREATE_ERRORS = {
+    PHONE_USER: 'Error creating phone number user',
+    EMAIL_PASSWORD_USER: 'Error creating email user',
+    EMAIL_USER: 'Error creating email user',
+    PROVIDER_USER: 'Error creating provider user',
+}
+
+# Lock for file writing
+file_lock = threading.Lock()
+
+# Error responses to a create request with embedded identities whose body shows Keycloak
+# rejected the identities themselves (unrecognized field or identity provider error)
+IDENTITIES_REJECTED_STATUSES = (400, 500)
+IDENTITIES_REJECTED_MARKERS = ('federatedidentities', 'identity provider', 'identityprovider')
+# Cleared, for the rest of the run, once Keycloak rejects embedded identities
+embed_identities = EMBED_IDENTITIES
+# Provider users linked in the create request ('embedded') or by separate requests ('two-step')
+provider_paths = collections.Counter()
+provider_paths_lock = threading.Lock()
+
+# Outcome counters and request latencies for the progress line, metrics file and summary
+metrics = Metrics()
+
+def count_provider_path(path):
+    with provider_paths_lock:
+        provider_paths[path] += 1
+
+def identities_rejected(response):
+    '''
+    Helper function to check whether a create request with embedded identities must be
+    retried in two steps. Switches the run to two-step linking when Keycloak rejects them.
+    Other errors go through the usual failure and retry handling.
+    '''
+    global embed_identities
+    if response is None or response.status_code not in IDENTITIES_REJECTED_STATUSES:
+        return False
+    body = (response.text or '').lower()
+    if not any(marker in body for marker in IDENTITIES_REJECTED_MARKERS):
+        return False
+    if embed_identities:
+        embed_identities = False
+        print(f'Keycloak rejected embedded federated identities ({response.status_code}), linking them in separate requests')
+    return True
+
+# Run ID naming the log folder. The nodes of a sharded run are given the same RUN_ID
+# and each writes to its own shard_<i>_of_<n> sub folder.
+run_id = os.getenv('RUN_ID') or f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:6]}'
+log_folder = os.getenv('LOG_FILE_PATH', 'Log') + f'logs_{run_id}'
+
+# Shared background writer of the queue logging mode, started by the first logger
+log_writer = None
+# Number of this worker process (from 1) when the run uses several, else None
+worker_process = None
+
+def setup_logger(thread_num):
+    '''
+    This will setup logger to store log files in the run's log folder.
+    In queue mode every thread logs to run_log.ndjson through one background writer.
+    '''
+    global log_writer
+    os.makedirs(log_folder, exist_ok=True)
+    logger = logging.getLogger(f'Thread-{thread_num}')
+    logger.setLevel(LOG_LEVEL)
+    # Thread logs only go to the run's files, never to the console
+    logger.propagate = False
+    if LOG_MODE == 'queue':
+        with file_lock:
+            if log_writer is None:
+                # Every worker process has its own writer and file
+                file_name = f'run_log_process_{worker_process}.ndjson' if worker_process else 'run_log.ndjson'
+                log_writer = LogWriter(os.path.join(log_folder, file_name))
+        logger.addFilter(UserContextFilter())
+        logger.addHandler(QueueLogHandler(log_writer))
+        return logger
+    log_file = os.path.join(log_folder, f'thread_{thread_num}_log.txt')
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    return logger
+
+def load_json(file_path):
     '''
-    Get KeyCloak Admin Token
+    Helper function to load json file
     '''
-    keycloak_url = os.getenv('KEYCLOAK_URL')
-    realm_name = os.getenv('REALM_NAME')
-    client_id = os.getenv('CLIENT_ID')
-    client_secret = os.getenv('CLIENT_SECRET')
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        logging.error(f'Error loading IDs from file {file_path}: {e}')
+        return []
 
-    token_url = f'{keycloak_url}/realms/{realm_name}/protocol/openid-connect/token'
-    payload = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret
-    }
-    
+def write_to_file(data, file_path):
+    '''
+    Helper function to write to a file
+    '''
     try:
-        response = requests.post(token_url, data=payload)
-        if response.status_code == 200:
-            token_data = response.json()
-            return token_data.get('access_token')
-        else:
-            print(f"Failed to obtain admin token: {response.text}")
-            return None
+        with open(file_path, 'w') as f:
+            json.dump(list(data), f, indent=4)
     except Exception as e:
-        print(f"Error obtaining admin token: {e}")
-        return None
+        logging.error(f'Error writing data to file {file_path}: {e}')
 
-# Obtain the admin token
-# ADMIN_TOKEN = get_admin_token()
-ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+class Journal:
+    '''
+    Append-only NDJSON journal of user outcomes for a thread. Every outcome is written
+    as soon as it is recorded, so a crashed run never forgets a user Keycloak already
+    holds and --resume does not create it again (phone users would not even conflict).
+    Outcomes are also passed on, with their details, to the run's RunStore.
+    '''
+    def __init__(self, thread_num, store):
+        self.thread_num = thread_num
+        self.store = store
+        self.file = open(os.path.join(log_folder, f'journal_thread_{thread_num}.ndjson'), 'a')
 
-# Lock for file writing
-file_lock = threading.Lock()
+    def record(self, local_id, status, user=None, error=None, response=None):
+        # Reaching the OS is enough to survive a process crash, no fsync needed
+        self.file.write(json.dumps({'localId': local_id, 'status': status}) + '\n')
+        self.file.flush()
+        kind = email = user_fingerprint = None
+        if user is not None:
+            # Compiled records carry their kind and fingerprint, raw Firebase users are classified
+            kind = user['kind'] if 'kind' in user else classify_user(user)
+            email = user.get('email')
+            user_fingerprint = user['fingerprint'] if 'fingerprint' in user else fingerprint(user)
+        metrics.record_outcome(status, kind)
+        self.store.record(local_id, status, kind, email, error, response, self.thread_num, user_fingerprint)
 
-# Timestamp for log folder
-timestamp = str(int(time.time()))
+    def close(self):
+        self.file.close()
+
+def read_journals(folder_path):
+    '''
+    Read every thread journal in a logs folder.
+    Returns {thread_num: {localId: status}} keeping the last status of each user.
+    '''
+    journals = {}
+    for file_name in os.listdir(folder_path):
+        if file_name.startswith('journal_thread_') and file_name.endswith('.ndjson'):
+            thread_num = int(file_name[len('journal_thread_'):-len('.ndjson')])
+            statuses = journals.setdefault(thread_num, {})
+            with open(os.path.join(folder_path, file_name)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut short by a crash
+                        continue
+                    statuses[entry['localId']] = entry['status']
+    return journals
+
+def prepare_resume(folder_path):
+    '''
+    Rebuild the report files of an interrupted run from its journals and return the
+    set of user ids that are already migrated or skipped. Failed and unprocessed users
+    are left out of the rebuilt reports because the resumed run retries them.
+    '''
+    completed_ids = set()
+    for thread_num, statuses in read_journals(folder_path).items():
+        processed_ids = [local_id for local_id, status in statuses.items() if status == 'processed']
+        skipped_ids = [local_id for local_id, status in statuses.items() if status == 'skipped']
+        completed_ids.update(processed_ids)
+        completed_ids.update(skipped_ids)
+        write_to_file(processed_ids, f'{folder_path}/processed_ids_thread_{thread_num}.json')
+        write_to_file(skipped_ids, f'{folder_path}/skipped_ids_thread_{thread_num}.json')
+        for name in ('unprocessed_ids', 'failed_ids', 'failed_records'):
+            write_to_file([], f'{folder_path}/{name}_thread_{thread_num}.json')
+    return completed_ids
 
 class UserProcessor(threading.Thread):
-    def __init__(self, thread_num, users_data):
+    def __init__(self, thread_num, users_data, session, controller, tokens, store, preflight=None, delta=None):
         # Initialize thread attributes
         super().__init__()
         self.thread_num = thread_num
         self.users_data = users_data
-        self.log_folder = os.getenv('LOG_FILE_PATH', 'Log') + f'logs_{timestamp}'
-        self.logger = self.setup_logger()
-
-    def setup_logger(self):
-        '''
-        This will setup logger to store log files in a sub folder along with timestamp
-        '''
-        os.makedirs(self.log_folder, exist_ok=True)
-        log_file = os.path.join(self.log_folder, f'thread_{self.thread_num}_log.txt')
-        logger = logging.getLogger(f'Thread-{self.thread_num}')
-        logger.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        file_handler = logging.FileHandler(log_file)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-        return logger
+        # Shared keep-alive session and concurrency controller for Keycloak requests
+        self.session = session
+        self.controller = controller
+        self.tokens = tokens
+        self.store = store
+        # Known conflicts, routed without a request when pre-flight is enabled
+        self.preflight = preflight
+        # Previous run to compare users with in delta mode
+        self.delta = delta
+        self.log_folder = log_folder
+        self.logger = setup_logger(thread_num)
+        # Pending (user, user_data) pairs for bulk import mode
+        self.import_batch = []
+        # Skipped ids report of the run, for users partialImport skips as already existing
+        self.import_skipped_ids = []
+        # Throughput of this thread for the run summary
+        self.records_processed = 0
+        self.elapsed = 0.0
 
     def run(self):
-        # Set KeyCloak users URL and authentication headers 
+        # Set KeyCloak users URL
         url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users'
-        headers = {'Authorization': f'Bearer {ADMIN_TOKEN}', 'Content-Type': 'application/json'}
 
         # Store execution data for overall report
         processed_ids_file = f'{self.log_folder}/processed_ids_thread_{self.thread_num}.json'
@@ -85,302 +269,1186 @@ class UserProcessor(threading.Thread):
         skipped_ids_file = f'{self.log_folder}/skipped_ids_thread_{self.thread_num}.json'
         failed_records_file = f'{self.log_folder}/failed_records_thread_{self.thread_num}.json'
 
-        processed_ids = self.load_json(processed_ids_file)
-        unprocessed_ids = self.load_json(unprocessed_ids_file)
-        failed_ids = self.load_json(failed_ids_file)
-        skipped_ids = self.load_json(skipped_ids_file)
-        failed_records = self.load_json(failed_records_file)
+        processed_ids = load_json(processed_ids_file)
+        unprocessed_ids = load_json(unprocessed_ids_file)
+        failed_ids = load_json(failed_ids_file)
+        skipped_ids = load_json(skipped_ids_file)
+        failed_records = load_json(failed_records_file)
+        self.import_skipped_ids = skipped_ids
 
-        # Process records for a thread
+        self.journal = Journal(self.thread_num, self.store)
+
+        # Process records pulled from the shared queue until it is exhausted
+        start_time = time.time()
         for i, user in enumerate(self.users_data):
-            print(f'Processing record... - userId: {user["localId"]} (Thread {self.thread_num}) (Index {i})')
-            self.logger.info('|------------------------------------------------------------------------|')
-            self.logger.info(f'Processing record... - userId: {user["localId"]} (Thread {self.thread_num}) (Index {i})')
+            self.records_processed = i + 1
+            current_user_id.set(user['localId'])
+            self.logger.debug('|------------------------------------------------------------------------|')
+            self.logger.debug(f'Processing record... - userId: {user["localId"]} (Thread {self.thread_num}) (Index {i})')
 
             try:
                 success = False
-                # Note: Duplicate phone user is not handled unless it used as username
-                if 'phoneNumber' in user and 'passwordHash' not in user:
+                kind = user['kind'] if 'payload' in user else classify_user(user)
+                change = self.delta.compare(user) if self.delta and kind not in SKIPPED_KINDS else None
+                # Users migrated by the previous run exist in Keycloak, so only new users are checked
+                conflict = self.preflight.check(user, kind) if self.preflight and kind not in SKIPPED_KINDS and change not in (CHANGED, UNCHANGED) else None
+                if change == UNCHANGED:
+                    self.logger.info('Unchanged since previous run, not sending user')
+                    processed_ids.append(user['localId'])
+                    self.journal.record(user['localId'], 'processed', user, 'Unchanged since previous run')
+                elif change == CHANGED:
+                    self.logger.info('Changed since previous run, updating user')
+                    success = self.update_user(user, kind, url, processed_ids, failed_ids, failed_records)
+                elif conflict:
+                    # Known duplicates and existing users are not sent to Keycloak
+                    status, reason = conflict
+                    self.logger.info(f'{reason}, not sending user')
+                    (processed_ids if status == 'processed' else skipped_ids).append(user['localId'])
+                    self.journal.record(user['localId'], status, user, reason)
+                elif 'payload' in user and kind not in SKIPPED_KINDS:
+                    # Send payloads prepared by compile-users.py
+                    self.logger.debug(f'Processing compiled {kind} user...')
+                    success = self.process_compiled_user(user, url, processed_ids, failed_ids, failed_records)
+                elif kind == PHONE_USER:
                     # Process phone number users
-                    self.logger.info('Processing phone number user...')
-                    success = self.process_phone_number_user(user, url, headers, processed_ids, failed_ids, failed_records)
-
-                elif 'email' in user and 'passwordHash' in user:
+                    self.logger.debug('Processing phone number user...')
+                    success = self.process_phone_number_user(user, url, processed_ids, failed_ids, failed_records)
+                elif kind == EMAIL_PASSWORD_USER:
                     # Process email users (records with passwordHash)
-                    self.logger.info('Processing email-password user...')
-                    success = self.process_email_user(user, url, headers, processed_ids, failed_ids, failed_records)
-
-                elif 'providerUserInfo' in user and len(user['providerUserInfo']) > 0:
+                    self.logger.debug('Processing email-password user...')
+                    success = self.process_email_user(user, url, processed_ids, failed_ids, failed_records)
+                elif kind == PROVIDER_USER:
                     # Process users with provider information (Social Login)
-                    providerAvailable = False
-                    for provider in user['providerUserInfo']:
-                        # Records with 'facebookProvider' will be processed without adding facebook provider
-                        if provider['providerId'] in ['google.com', 'facebook.com']:
-                            providerAvailable = True
-                    if providerAvailable:
-                        self.logger.info('Processing user with Google/Facebook provider...')
-                        success = self.process_provider_user(user, url, headers, processed_ids, failed_ids, failed_records)
-                    else:
-                        self.logger.error(f'Skipping the provider user without Google Login with data - {user}')
-                        skipped_ids.append(user['localId'])
-                elif 'email' in user:
+                    self.logger.debug('Processing user with Google/Facebook provider...')
+                    success = self.process_provider_user(user, url, processed_ids, failed_ids, failed_records)
+                elif kind == SKIPPED_PROVIDER_USER:
+                    self.logger.error('Skipping the provider user without Google Login with data - %s', redact(user))
+                    skipped_ids.append(user['localId'])
+                    self.journal.record(user['localId'], 'skipped', user)
+                elif kind == EMAIL_USER:
                     # Process email users
-                    self.logger.info('Processing email user...')
-                    success = self.process_email_user(user, url, headers, processed_ids, failed_ids, failed_records)
+                    self.logger.debug('Processing email user...')
+                    success = self.process_email_user(user, url, processed_ids, failed_ids, failed_records)
                 else:
-                    self.logger.error(f'Skipping the user with invalid user data. {user}')
+                    self.logger.error('Skipping the user with invalid user data. %s', redact(user))
                     skipped_ids.append(user['localId'])
+                    self.journal.record(user['localId'], 'skipped', user)
 
             except Exception as e:
                 self.logger.error(f'Error processing user: {e}')
-                self.logger.info('|------------------------------------------------------------------------|')
-                self.logger.info('\n')
+                self.logger.debug('|------------------------------------------------------------------------|')
+                self.logger.debug('\n')
                 unprocessed_ids.append(user["localId"])
+                self.journal.record(user["localId"], 'unprocessed', user, e)
                 continue
-            self.logger.info('|------------------------------------------------------------------------|')
-            self.logger.info('\n')
+            self.logger.debug('|------------------------------------------------------------------------|')
+            self.logger.debug('\n')
+
+        # Import users still waiting in the last partial batch
+        if self.import_batch:
+            self.import_users(processed_ids, failed_ids, failed_records)
+
+        self.elapsed = time.time() - start_time
+        self.logger.info(f'Processed {self.records_processed} records in {self.elapsed:.2f} seconds ({self.throughput():.2f} records/sec)')
 
         # Update processed/failed/skipped IDs file
         with file_lock:
-            self.write_to_file(processed_ids, processed_ids_file)
-            self.write_to_file(unprocessed_ids, unprocessed_ids_file)
-            self.write_to_file(failed_ids, failed_ids_file)
-            self.write_to_file(failed_records, failed_records_file)
-            self.write_to_file(skipped_ids, skipped_ids_file)
+            write_to_file(processed_ids, processed_ids_file)
+            write_to_file(unprocessed_ids, unprocessed_ids_file)
+            write_to_file(failed_ids, failed_ids_file)
+            write_to_file(failed_records, failed_records_file)
+            write_to_file(skipped_ids, skipped_ids_file)
+        self.journal.close()
 
-    def load_json(self, file_path):
+    def throughput(self):
         '''
-        Helper function to load json file
+        Records processed per second by this thread
         '''
-        try:
-            with open(file_path) as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return []
-        except Exception as e:
-            logging.error(f'Error loading IDs from file {file_path}: {e}')
-            return []
+        return self.records_processed / self.elapsed if self.elapsed else 0.0
 
-    def write_to_file(self, data, file_path):
-        '''
-        Helper function to write to a file
-        '''
-        try:
-            with open(file_path, 'w') as f:
-                json.dump(list(data), f, indent=4)
-        except Exception as e:
-            logging.error(f'Error writing data to file {file_path}: {e}')
-
-    def process_phone_number_user(self, user, url, headers, processed_ids, failed_ids, failed_records):
+    def process_phone_number_user(self, user, url, processed_ids, failed_ids, failed_records):
         '''
         Helper function to process phone user
         '''
         local_id = user['localId']
-        display_name = self.get_display_name(user)
-        first_name = display_name[0] if display_name else None
-        last_name = display_name[1] if len(display_name) > 1 else None
-        photo_url = user.get('photoUrl', '')
-        user_data = {
-            'username': str(uuid.uuid4()),
-            'firstName': first_name,
-            'lastName': last_name,
-            'email': user.get('email', ''),
-            'emailVerified': user.get('emailVerified', False),
-            'enabled': not user.get('disabled', False),
-            'attributes': {
-                'phoneNumber': user['phoneNumber'],
-                'phoneNumberVerified': True,
-                'userId': local_id,
-            },
-        }
-        if photo_url:
-            user_data['attributes']['photoUrl'] = photo_url
-        self.logger.info(f'Creating user with phone number')
-        response = self.create_user(url, headers, user_data)
+        user_data = build_phone_number_user_data(user)
+        if BULK_IMPORT:
+            return self.add_to_import_batch(user, user_data, processed_ids, failed_ids, failed_records)
+        self.logger.debug(f'Creating user with phone number')
+        response = self.create_user(url, user_data)
         if response and response.status_code == 201:
             self.logger.info('User created successfully with phone number.')
             processed_ids.append(local_id)
+            self.journal.record(local_id, 'processed', user, response=response)
             return True
         else:
             error_message = f'Error creating phone number user: {response.text}'
             self.logger.error(error_message)
             failed_ids.append(local_id)
+            self.journal.record(local_id, 'failed', user, error_message, response)
             user['error'] = error_message
             failed_records.append(user)
             return False
 
-    def process_email_user(self, user, url, headers, processed_ids, failed_ids, failed_records):
+    def process_email_user(self, user, url, processed_ids, failed_ids, failed_records):
         '''
         Helper function to process email user
         '''
         local_id = user['localId']
-        display_name = self.get_display_name(user)
-        first_name = display_name[0] if display_name else None
-        last_name = display_name[1] if len(display_name) > 1 else None
-        photo_url = user.get('photoUrl', '')
-
-        user_data = {
-            'username': str(uuid.uuid4()),
-            'email': user['email'],
-            'emailVerified': user['emailVerified'],
-            'enabled': True,
-            'firstName': first_name,
-            'lastName': last_name,
-            'attributes': {
-                'phoneNumber': user.get('phoneNumber'),
-                'phoneNumberVerified': user.get('phoneNumberVerified', False),
-                'userId': local_id,
-            }
-        }
-
-        if 'passwordHash' in user:
-            user_data['credentials'] = [{
-                "hashedSaltedValue": user['passwordHash'],
-                "salt": user['salt'],
-                "hashIterations": -1,
-                "algorithm": "firebase-scrypt",
-                "temporary": False,
-                "type": "password"
-                }]
-            user_data['enabled'] = not user.get('disabled', False)
-        
-        if photo_url:
-            user_data['attributes']['photoUrl'] = photo_url
-
-        response = self.create_user(url, headers, user_data)
+        user_data = build_email_user_data(user)
+        if BULK_IMPORT:
+            return self.add_to_import_batch(user, user_data, processed_ids, failed_ids, failed_records)
+        response = self.create_user(url, user_data)
         if response and response.status_code == 201:
             self.logger.info('User created successfully with email.')
             processed_ids.append(local_id)
+            self.journal.record(local_id, 'processed', user, response=response)
             return True
         else:
             error_message = f'Error creating email user: {response.text}'
             self.logger.error(error_message)
             failed_ids.append(local_id)
+            self.journal.record(local_id, 'failed', user, error_message, response)
             user['error'] = error_message
             failed_records.append(user)
             return False
 
-    def process_provider_user(self, user, url, headers, processed_ids, failed_ids, failed_records):
+    def process_provider_user(self, user, url, processed_ids, failed_ids, failed_records):
         '''
         Helper function to process provicer user i.e. user with Social Login
         '''
         local_id = user['localId']
-        display_name = self.get_display_name(user)
-        first_name = display_name[0] if display_name else None
-        last_name = display_name[1] if len(display_name) > 1 else None
-
-        user_data = {
-            'username': str(uuid.uuid4()),
-            'email': user.get('email'),
-            'emailVerified': user.get('emailVerified', False),
-            'firstName': first_name,
-            'lastName': last_name,
-            'enabled': not user.get('disabled', False),
-            'attributes': {
-                'phoneNumber': user.get('phoneNumber'),
-                'phoneNumberVerified': user.get('phoneNumberVerified', False),
-                'userId': local_id,
-                'photoUrl': user.get('photoUrl', '')
-            },
-        }
+        user_data = build_provider_user_data(user)
+        if BULK_IMPORT:
+            # Google identities are linked as part of the import itself
+            user_data['federatedIdentities'] = build_federated_identities(user)
+            return self.add_to_import_batch(user, user_data, processed_ids, failed_ids, failed_records)
 
-        response = self.create_user(url, headers, user_data)
+        response = self.create_provider_user(url, user_data, build_federated_identities(user))
         if response and response.status_code == 201:
             self.logger.info('User created successfully.')
-            # Get user id from response header `Location``
-            location_header = response.headers.get('Location')
-            user_id = location_header.split('/')[-1]
-            for provider in user['providerUserInfo']:
-                if provider['providerId'] == 'google.com':
-                    self.logger.info('Adding Google provider to user.')
-                    # Add Google provider to user
-                    identityProvider = 'google'
-                    social_data = {
-                        'identityProvider': identityProvider,
-                        'userId': provider['rawId'],
-                        'userName': provider['email'] if 'email' in provider else provider['displayName'],
-                    }
-                    url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users/{user_id}/federated-identity/{identityProvider}'
-                    response = requests.post(url, headers=headers, data=json.dumps(social_data))
-                    if response.status_code == 204:
-                        self.logger.info(f'Added Google provider to user - ID: {user_id} and Provider ID: {provider["rawId"]}')
-                    else:
-                        self.logger.error(f'Error adding Google provider to user: {response.text}')
             processed_ids.append(local_id)
+            self.journal.record(local_id, 'processed', user, response=response)
             return True
         else:
             error_message = f'Error creating provider user: {response.text}'
             self.logger.error(error_message)
             failed_ids.append(local_id)
+            self.journal.record(local_id, 'failed', user, error_message, response)
             user['error'] = error_message
             failed_records.append(user)
             return False
 
-    def create_user(self, url, headers, user_data):
+    def create_provider_user(self, url, user_data, identities):
+        '''
+        Helper function to create provider user with its Google identities in one request,
+        falling back to linking them after the create when Keycloak rejects embedded identities
+        '''
+        if identities and embed_identities:
+            response = self.create_user(url, with_identities(user_data, identities))
+            if not identities_rejected(response):
+                if response is not None and response.status_code == 201:
+                    count_provider_path('embedded')
+                return response
+            self.logger.warning('Embedded identities rejected, creating user and linking Google provider separately')
+        response = self.create_user(url, user_data)
+        if identities and response is not None and response.status_code == 201:
+            self.add_providers(response, identities)
+            count_provider_path('two-step')
+        return response
+
+    def add_providers(self, response, identities):
+        '''
+        Helper function to link Google providers to a provider user created by `response`
+        '''
+        # Get user id from response header `Location``
+        location_header = response.headers.get('Location')
+        user_id = location_header.split('/')[-1]
+        for social_data in identities:
+            self.logger.info('Adding Google provider to user.')
+            identity_provider = social_data['identityProvider']
+            url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users/{user_id}/federated-identity/{identity_provider}'
+            response = self.post(url, social_data)
+            if response.status_code == 204:
+                self.logger.info(f'Added Google provider to user - ID: {user_id} and Provider ID: {social_data["userId"]}')
+            else:
+                self.logger.error(f'Error adding Google provider to user: {response.text}')
+
+    def process_compiled_user(self, record, url, processed_ids, failed_ids, failed_records):
+        '''
+        Helper function to send a payload prepared by compile-users.py as is
+        '''
+        local_id = record['localId']
+        if BULK_IMPORT:
+            user_data = json.loads(record.pop('payload'))
+            if record.get('identities'):
+                user_data['federatedIdentities'] = record.pop('identities')
+            return self.add_to_import_batch(record, user_data, processed_ids, failed_ids, failed_records)
+        if record['kind'] == PROVIDER_USER:
+            response = self.create_provider_user(url, record.pop('payload'), record['identities'])
+        else:
+            response = self.create_user(url, record.pop('payload'))
+        if response and response.status_code == 201:
+            self.logger.info('User created successfully.')
+            processed_ids.append(local_id)
+            self.journal.record(local_id, 'processed', record, response=response)
+            return True
+        else:
+            error_message = f'{CREATE_ERRORS[record["kind"]]}: {response.text}'
+            self.logger.error(error_message)
+            failed_ids.append(local_id)
+            self.journal.record(local_id, 'failed', record, error_message, response)
+            record['error'] = error_message
+            failed_records.append(record)
+            return False
+
+    def update_user(self, user, kind, url, processed_ids, failed_ids, failed_records):
+        '''
+        Helper function to update user that changed since the previous run, found in Keycloak
+        by its userId attribute. A user missing from Keycloak is created instead; a failed
+        lookup is recorded as failed, since the previous run did create the user.
+        '''
+        local_id = user['localId']
+        if 'payload' in user:
+            user_data = json.loads(user.pop('payload'))
+            identities = user.get('identities') or []
+        else:
+            user_data = build_user_data(user, kind)
+            identities = build_federated_identities(user) if kind == PROVIDER_USER else []
+        # Keep the username given when the user was created
+        username = user_data.pop('username')
+
+        response = self.send('GET', f'{url}?q={quote(f"userId:{local_id}")}&exact=true')
+        if response is None or response.status_code != 200:
+            # The user exists since the previous run, so a failed lookup must not create it again
+            expected_status = None
+            action = 'looking up'
+        elif response.json():
+            action = 'updating'
+            keycloak_id = response.json()[0]['id']
+            response = self.send('PUT', f'{url}/{keycloak_id}', user_data)
+            expected_status = 204
+            if response.status_code == expected_status:
+                self.logger.info(f'User updated successfully - ID: {keycloak_id}')
+                self.link_identities(keycloak_id, identities)
+        else:
+            self.logger.warning('User to update not found in Keycloak, creating it')
+            action = 'creating'
+            user_data['username'] = username
+            response = self.create_provider_user(url, user_data, identities) if identities else self.create_user(url, user_data)
+            expected_status = 201
+
+        if response is not None and response.status_code == expected_status:
+            processed_ids.append(local_id)
+            self.journal.record(local_id, 'processed', user, response=response)
+            return True
+        error_message = f'Error {action} user to update: {response.text if response is not None else "No response"}'
+        self.logger.error(error_message)
+        failed_ids.append(local_id)
+        self.journal.record(local_id, 'failed', user, error_message, response)
+        user['error'] = error_message
+        failed_records.append(user)
+        return False
+
+    def link_identities(self, keycloak_id, identities):
+        '''
+        Helper function to link Google providers to an existing user, accepting links that already exist
+        '''
+        for social_data in identities:
+            url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users/{keycloak_id}/federated-identity/{social_data["identityProvider"]}'
+            response = self.post(url, social_data)
+            if response.status_code not in (204, 409):
+                self.logger.error(f'Error adding Google provider to user: {response.text}')
+
+    def add_to_import_batch(self, user, user_data, processed_ids, failed_ids, failed_records):
+        '''
+        Helper function to queue user for bulk import, importing the batch once it is full
+        '''
+        self.import_batch.append((user, user_data))
+        if len(self.import_batch) >= BULK_BATCH_SIZE:
+            self.import_users(processed_ids, failed_ids, failed_records)
+        return True
+
+    def import_users(self, processed_ids, failed_ids, failed_records):
+        '''
+        Helper function to import pending batch of users with Keycloak partialImport
+        '''
+        batch = self.import_batch
+        self.import_batch = []
+        self.import_batch_chunk(batch, processed_ids, failed_ids, failed_records)
+
+    def import_batch_chunk(self, batch, processed_ids, failed_ids, failed_records):
+        '''
+        Helper function to send one partialImport request and record per-user results
+        '''
+        url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/partialImport'
+        payload = {
+            'ifResourceExists': BULK_IF_EXISTS,
+            'users': [user_data for _, user_data in batch],
+        }
+        self.logger.info(f'Importing batch of {len(batch)} users')
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(user_data))
+            response = self.post(url, payload, weight=len(batch))
+        except Exception as e:
+            self.logger.error(f'Error importing users: {e}')
+            response = None
+
+        if response is not None and response.status_code == 200:
+            # Map per-user results back to Firebase ids through the generated username
+            actions = {}
+            for result in response.json().get('results', []):
+                if result.get('resourceType') == 'USER':
+                    actions[result.get('resourceName')] = result.get('action')
+            for user, user_data in batch:
+                action = actions.get(user_data['username'])
+                if action in ('ADDED', 'OVERWRITTEN'):
+                    processed_ids.append(user['localId'])
+                    self.journal.record(user['localId'], 'processed', user, response=response)
+                elif action == 'SKIPPED':
+                    # Resending would be skipped again, so the user is not reported as failed
+                    reason = 'User exists with same username or email'
+                    self.logger.warning(f'{reason}, skipped by partialImport - userId: {user["localId"]}')
+                    self.import_skipped_ids.append(user['localId'])
+                    self.journal.record(user['localId'], 'skipped', user, reason)
+                else:
+                    error_message = 'Error importing user: User missing from import result'
+                    self.logger.error(f'{error_message} - userId: {user["localId"]}')
+                    failed_ids.append(user['localId'])
+                    self.journal.record(user['localId'], 'failed', user, error_message, response)
+                    user['error'] = error_message
+                    failed_records.append(user)
+            self.logger.info(f'Imported batch of {len(batch)} users')
+        elif len(batch) > 1 and (response is None or response.status_code not in (401, 403)):
+            # partialImport is transactional, so split the batch to isolate the failing records
+            self.logger.warning(f'Batch import failed, retrying {len(batch)} users in smaller batches')
+            middle = len(batch) // 2
+            self.import_batch_chunk(batch[:middle], processed_ids, failed_ids, failed_records)
+            self.import_batch_chunk(batch[middle:], processed_ids, failed_ids, failed_records)
+        else:
+            error_message = f'Error importing user: {response.text if response is not None else "No response"}'
+            self.logger.error(error_message)
+            for user, _ in batch:
+                failed_ids.append(user['localId'])
+                self.journal.record(user['localId'], 'failed', user, error_message, response)
+                user['error'] = error_message
+                failed_records.append(user)
+
+    def create_user(self, url, user_data):
+        try:
+            response = self.post(url, user_data)
             return response
         except Exception as e:
             self.logger.error(f'Error creating user: {e}')
             return None
-    
-    def get_display_name(self, user):
-        '''
-        Helper function to get display name from user data.
-        Falls back to email or phone number if display name is not available.
-        '''
-        if user.get('displayName'):
-            unicode_text = user['displayName']
-            safe_text = re.sub(r'\\u[0-9A-Fa-f]{0,3}(?![0-9A-Fa-f])', '', unicode_text)
-            converted_text = bytes(safe_text, 'utf-8').decode('unicode-escape')
-            return converted_text.split(' ')
-        elif user.get('email'):
-            email_name = user['email'].split('@')[0]
-            return email_name.split('.')
-        elif user.get('phoneNumber'):
-            phone_name = user['phoneNumber'].replace('+', '').replace(' ', '')
-            return [phone_name]
+
+    def post(self, url, data, weight=1):
+        return self.send('POST', url, data, weight)
+
+    def send(self, method, url, data=None, weight=1):
+        '''
+        Send a request with optional JSON data to Keycloak under the shared concurrency limit.
+        A request rejected with 401 is replayed once with a refreshed admin token.
+        '''
+        body = data if data is None or isinstance(data, str) else json.dumps(data)
+        for attempt in range(2):
+            token = self.tokens.get()
+            headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+            response = self.controller.request(
+                lambda: self.session.request(method, url, headers=headers, data=body, timeout=REQUEST_TIMEOUT),
+                weight=weight,
+            )
+            if response.status_code != 401 or attempt or not self.tokens.invalidate(token):
+                return response
+            self.logger.warning('Admin token rejected, retrying with a refreshed token')
+
+class AsyncUserProcessor:
+    '''
+    Processes users on a single asyncio event loop with at most MAX_IN_FLIGHT
+    concurrent requests, writing the same report files as a UserProcessor thread.
+    '''
+    def __init__(self, thread_num, users_data, controller, tokens, store, preflight=None, delta=None):
+        self.thread_num = thread_num
+        self.users_data = users_data
+        self.controller = controller
+        self.tokens = tokens
+        self.store = store
+        self.preflight = preflight
+        self.delta = delta
+        self.log_folder = log_folder
+        self.logger = setup_logger(thread_num)
+        self.total_users = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def run(self):
+        asyncio.run(self.process_users())
+
+    async def process_users(self):
+        # aiohttp is only needed by the async engine
+        import aiohttp
+        self.connection_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+        url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users'
+
+        processed_ids_file = f'{self.log_folder}/processed_ids_thread_{self.thread_num}.json'
+        unprocessed_ids_file = f'{self.log_folder}/unprocessed_ids_thread_{self.thread_num}.json'
+        failed_ids_file = f'{self.log_folder}/failed_ids_thread_{self.thread_num}.json'
+        skipped_ids_file = f'{self.log_folder}/skipped_ids_thread_{self.thread_num}.json'
+        failed_records_file = f'{self.log_folder}/failed_records_thread_{self.thread_num}.json'
+
+        self.processed_ids = load_json(processed_ids_file)
+        self.unprocessed_ids = load_json(unprocessed_ids_file)
+        self.failed_ids = load_json(failed_ids_file)
+        self.skipped_ids = load_json(skipped_ids_file)
+        self.failed_records = load_json(failed_records_file)
+        self.journal = Journal(self.thread_num, self.store)
+
+        # Count new and reused connections for the run summary
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_created)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reused)
+        connector = aiohttp.TCPConnector(limit=MAX_IN_FLIGHT)
+        timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
+
+        semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+        tasks = set()
+        loop = asyncio.get_event_loop()
+        users = iter(self.users_data)
+        done = object()
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config]) as session:
+                try:
+                    for i in itertools.count():
+                        # Reading may wait on the dump, a worker's user queue or a pipeline stage,
+                        # so it runs off the event loop and in-flight requests keep going
+                        user = await loop.run_in_executor(None, next, users, done)
+                        if user is done:
+                            break
+                        self.total_users += 1
+                        await semaphore.acquire()
+                        task = asyncio.ensure_future(self.process_user(session, semaphore, user, i, url))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                finally:
+                    # Users already read finish before the session closes, also when reading failed
+                    if tasks:
+                        await asyncio.gather(*tasks)
+        finally:
+            write_to_file(self.processed_ids, processed_ids_file)
+            write_to_file(self.unprocessed_ids, unprocessed_ids_file)
+            write_to_file(self.failed_ids, failed_ids_file)
+            write_to_file(self.failed_records, failed_records_file)
+            write_to_file(self.skipped_ids, skipped_ids_file)
+            self.journal.close()
+
+    async def on_connection_created(self, session, trace_config_ctx, params):
+        self.connections_opened += 1
+
+    async def on_connection_reused(self, session, trace_config_ctx, params):
+        self.connections_reused += 1
+
+    async def process_user(self, session, semaphore, user, index, url):
+        '''
+        Classify, build and create one user, releasing its in-flight slot when done
+        '''
+        local_id = user['localId']
+        current_user_id.set(local_id)
+        try:
+            self.logger.debug(f'Processing record... - userId: {local_id} (Thread {self.thread_num}) (Index {index})')
+            compiled = 'payload' in user
+            kind = user['kind'] if compiled else classify_user(user)
+            if kind == SKIPPED_PROVIDER_USER:
+                self.logger.error('Skipping the provider user without Google Login with data - %s', redact(user))
+                self.skipped_ids.append(local_id)
+                self.journal.record(local_id, 'skipped', user)
+                return
+            elif kind in SKIPPED_KINDS:
+                self.logger.error('Skipping the user with invalid user data. %s', redact(user))
+                self.skipped_ids.append(local_id)
+                self.journal.record(local_id, 'skipped', user)
+                return
+
+            change = self.delta.compare(user) if self.delta else None
+            if change == UNCHANGED:
+                self.logger.info(f'Unchanged since previous run, not sending user - userId: {local_id}')
+                self.processed_ids.append(local_id)
+                self.journal.record(local_id, 'processed', user, 'Unchanged since previous run')
+                return
+            elif change == CHANGED:
+                await self.update_user(session, user, kind, compiled, url)
+                return
+
+            conflict = self.preflight.check(user, kind) if self.preflight else None
+            if conflict:
+                # Known duplicates and existing users are not sent to Keycloak
+                status, reason = conflict
+                self.logger.info(f'{reason}, not sending user - userId: {local_id}')
+                (self.processed_ids if status == 'processed' else self.skipped_ids).append(local_id)
+                self.journal.record(local_id, status, user, reason)
+                return
+
+            # Compiled records already carry the serialized payload
+            user_data = user.pop('payload') if compiled else build_user_data(user, kind)
+            if kind == PROVIDER_USER:
+                identities = user['identities'] if compiled else build_federated_identities(user)
+                response = await self.create_provider_user(session, url, user_data, identities)
+            else:
+                response = await self.post(session, url, user_data)
+            if response.status_code == 201:
+                self.logger.info(f'User created successfully - userId: {local_id}')
+                self.processed_ids.append(local_id)
+                self.journal.record(local_id, 'processed', user, response=response)
+            else:
+                error_message = f'{CREATE_ERRORS[kind]}: {response.text}'
+                self.logger.error(error_message)
+                self.failed_ids.append(local_id)
+                self.journal.record(local_id, 'failed', user, error_message, response)
+                user['error'] = error_message
+                self.failed_records.append(user)
+        except Exception as e:
+            self.logger.error(f'Error processing user {local_id}: {e!r}')
+            self.unprocessed_ids.append(local_id)
+            self.journal.record(local_id, 'unprocessed', user, e)
+        finally:
+            semaphore.release()
+
+    async def update_user(self, session, user, kind, compiled, url):
+        '''
+        Update a user that changed since the previous run, found in Keycloak by its
+        userId attribute. A user missing from Keycloak is created instead; a failed lookup
+        is recorded as failed, since the previous run did create the user.
+        '''
+        local_id = user['localId']
+        user_data = json.loads(user.pop('payload')) if compiled else build_user_data(user, kind)
+        if kind == PROVIDER_USER:
+            identities = user['identities'] if compiled else build_federated_identities(user)
+        else:
+            identities = []
+        # Keep the username given when the user was created
+        username = user_data.pop('username')
+
+        response = await self.send(session, 'GET', f'{url}?q={quote(f"userId:{local_id}")}&exact=true')
+        if response.status_code != 200:
+            # The user exists since the previous run, so a failed lookup must not create it again
+            expected_status = None
+            action = 'looking up'
+        elif json.loads(response.text):
+            action = 'updating'
+            keycloak_id = json.loads(response.text)[0]['id']
+            response = await self.send(session, 'PUT', f'{url}/{keycloak_id}', user_data)
+            expected_status = 204
+            if response.status_code == expected_status:
+                self.logger.info(f'User updated successfully - userId: {local_id}')
+                for social_data in identities:
+                    identity_url = f'{url}/{keycloak_id}/federated-identity/{social_data["identityProvider"]}'
+                    link_response = await self.post(session, identity_url, social_data)
+                    if link_response.status_code not in (204, 409):
+                        self.logger.error(f'Error adding Google provider to user: {link_response.text}')
+        else:
+            self.logger.warning(f'User to update not found in Keycloak, creating it - userId: {local_id}')
+            action = 'creating'
+            user_data['username'] = username
+            if identities:
+                response = await self.create_provider_user(session, url, user_data, identities)
+            else:
+                response = await self.post(session, url, user_data)
+            expected_status = 201
+
+        if response.status_code == expected_status:
+            self.processed_ids.append(local_id)
+            self.journal.record(local_id, 'processed', user, response=response)
         else:
-            return []
+            error_message = f'Error {action} user to update: {response.text}'
+            self.logger.error(error_message)
+            self.failed_ids.append(local_id)
+            self.journal.record(local_id, 'failed', user, error_message, response)
+            user['error'] = error_message
+            self.failed_records.append(user)
+
+    async def create_provider_user(self, session, url, user_data, identities):
+        '''
+        Create a provider user with its Google identities in one request, falling back
+        to linking them after the create when Keycloak rejects embedded identities
+        '''
+        if identities and embed_identities:
+            response = await self.post(session, url, with_identities(user_data, identities))
+            if not identities_rejected(response):
+                if response.status_code == 201:
+                    count_provider_path('embedded')
+                return response
+            self.logger.warning('Embedded identities rejected, creating user and linking Google provider separately')
+        response = await self.post(session, url, user_data)
+        if identities and response.status_code == 201:
+            await self.add_providers(session, identities, response.headers.get('Location').split('/')[-1])
+            count_provider_path('two-step')
+        return response
+
+    async def add_providers(self, session, identities, user_id):
+        '''
+        Link Google providers to a created provider user
+        '''
+        for social_data in identities:
+            identity_provider = social_data['identityProvider']
+            url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users/{user_id}/federated-identity/{identity_provider}'
+            response = await self.post(session, url, social_data)
+            if response.status_code == 204:
+                self.logger.info(f'Added Google provider to user - ID: {user_id} and Provider ID: {social_data["userId"]}')
+            else:
+                self.logger.error(f'Error adding Google provider to user: {response.text}')
+
+    async def post(self, session, url, data):
+        return await self.send(session, 'POST', url, data)
+
+    async def send(self, session, method, url, data=None):
+        '''
+        Send a request with optional JSON data under the shared concurrency limit, retrying
+        transient failures. A request rejected with 401 is replayed once with a refreshed admin token.
+        '''
+        body = data if data is None or isinstance(data, str) else json.dumps(data)
+        for attempt in range(2):
+            token = await self.tokens.get_async()
+            headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+
+            async def send():
+                start = time.monotonic()
+                async with session.request(method, url, headers=headers, data=body) as response:
+                    text = await response.text()
+                    elapsed = timedelta(seconds=time.monotonic() - start)
+                    return AsyncResponse(response.status, text, response.headers, elapsed)
+
+            response = await self.controller.request_async(send, self.connection_errors)
+            if response.status_code != 401 or attempt or not self.tokens.invalidate(token):
+                return response
+            self.logger.warning('Admin token rejected, retrying with a refreshed token')
+
+def logged_errors(users, source):
+    '''
+    Stream `users`, logging a read error before raising it, so a stream cut short
+    never looks like a finished run
+    '''
+    try:
+        yield from users
+    except Exception as e:
+        logging.error(f'Error loading {source}: {e}')
+        raise
 
 def load_users(file_path, num_users_to_process):
+    '''
+    Stream user records from the dump, stopping after `num_users_to_process` records if set
+    '''
+    users = iter_users(file_path)
+    if num_users_to_process:
+        users = itertools.islice(users, num_users_to_process)
+    return logged_errors(users, 'users')
+
+def retry_ids(folder_path):
+    '''
+    Ids of the failed and unprocessed users of a run, from its outcome database or its report files
+    '''
+    conn = open_store(folder_path)
+    if conn:
+        local_ids = ids_with_status(conn, ('failed', 'unprocessed'))
+        conn.close()
+        return local_ids
+    local_ids = []
+    for file_name in sorted(os.listdir(folder_path)):
+        if file_name.startswith(('failed_ids_thread_', 'unprocessed_ids_thread_')):
+            local_ids.extend(load_json(os.path.join(folder_path, file_name)))
+    return list(dict.fromkeys(local_ids))
+
+def load_indexed_users(dump_index, spans):
+    '''
+    Stream the records at `spans` of the dump through its byte-offset index
+    '''
+    return logged_errors(dump_index.iter_records(spans), 'users')
+
+def load_compiled_users(folder_path, num_users_to_process):
+    '''
+    Stream records from the payload shards written by compile-users.py
+    '''
+    def records():
+        for file_name in sorted(os.listdir(folder_path)):
+            if file_name.startswith('payloads_') and file_name.endswith('.ndjson'):
+                with open(os.path.join(folder_path, file_name)) as f:
+                    for line in f:
+                        yield parse_compiled(line)
+    users = records()
+    if num_users_to_process:
+        users = itertools.islice(users, num_users_to_process)
+    return logged_errors(users, 'compiled users')
+
+def staged(items, maxsize):
+    '''
+    Run an iterator on a background thread and hand its items over a bounded queue,
+    so consecutive pipeline stages overlap without reading ahead more than `maxsize` items
+    '''
+    stage_queue = queue.Queue(maxsize=maxsize)
+    done = object()
+    errors = []
+    def run():
+        try:
+            for item in items:
+                stage_queue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stage_queue.put(done)
+    threading.Thread(target=run, daemon=True).start()
+    for item in iter(stage_queue.get, done):
+        yield item
+    if errors:
+        raise errors[0]
+
+def validate_users(users, store, counts):
+    '''
+    Validation and payload stage of the single-pass pipeline. Records failing the
+    split-records.py rules are recorded as skipped and written, with their reasons, to
+    skipped_records.ndjson. Valid records are written to filtered_records.ndjson and
+    passed on as compiled records, so the workers only send them.
+    '''
+    # Outcomes of this stage are journaled as thread 0, apart from the workers
+    skipped_ids_file = f'{log_folder}/skipped_ids_thread_0.json'
+    skipped_ids = load_json(skipped_ids_file)
+    journal = Journal(0, store)
     try:
-        with open(file_path) as f:
-            data = json.load(f)
-            users_data = data['users'] if isinstance(data, dict) and 'users' in data else data
-            if num_users_to_process:
-                return users_data[:num_users_to_process]
-            return users_data
+        with open(os.path.join(log_folder, 'filtered_records.ndjson'), 'a') as filtered_out, \
+                open(os.path.join(log_folder, 'skipped_records.ndjson'), 'a') as skipped_out:
+            for user in users:
+                invalid_record = validate_record(user)
+                if invalid_record is None:
+                    counts['valid'] += 1
+                    write_record(filtered_out, user)
+                    yield compile_record(user)
+                    continue
+                counts['invalid'] += 1
+                write_record(skipped_out, invalid_record)
+                reasons = invalid_record['reasons']
+                skipped_ids.append(user['localId'])
+                journal.record(user['localId'], 'skipped', user, '; '.join(reasons.values()) if isinstance(reasons, dict) else reasons)
+    finally:
+        write_to_file(skipped_ids, skipped_ids_file)
+        journal.close()
+
+def run_preflight(users, controller, tokens):
+    '''
+    Index the dump for duplicates and the realm for existing users before the run
+    '''
+    start_time = time.time()
+    preflight = Preflight()
+    preflight.total_records = total_records = preflight.index_dump(users)
+    print(f'Pre-flight: {total_records} unique localIds, {len(preflight.repeated_ids)} repeated, '
+          f'{len(preflight.email_owners)} emails and {len(preflight.phone_owners)} phone numbers indexed')
+
+    try:
+        index_realm(preflight, controller, tokens)
     except Exception as e:
-        logging.error(f'Error loading users: {e}')
-        return None
+        # Dump duplicates are still routed, conflicts with Keycloak fall back to 409s
+        logging.error(f'Error indexing Keycloak users: {e}')
+    print(f'Pre-flight took {time.time() - start_time:.2f} seconds')
+    return preflight
 
-def main():
-    # Script execution starts here
-    start_time = time.time() # Record the start time
-    user_dump = os.getenv('USER_DUMP_FILE')
-    users_data = load_users(user_dump, NUM_USERS_TO_PROCESS)
-    if users_data:
-        threads = []
-        chunk_size = len(users_data) // NUM_THREADS
-        # Divide user data in chunks for specified number of threads
-        user_chunks = [users_data[i:i + chunk_size] for i in range(0, len(users_data), chunk_size)]
-
-        # Start threads for processing user data
-        for i in range(NUM_THREADS):
-            thread = UserProcessor(i + 1, user_chunks[i])
-            threads.append(thread)
-            thread.start()
+def index_realm(preflight, controller, tokens):
+    '''
+    Collect the emails and Firebase userIds of the realm's users into `preflight`
+    '''
+    session = create_session(PREFLIGHT_WORKERS)
+    get = admin_get(session, controller, tokens, REQUEST_TIMEOUT)
+    try:
+        existing = preflight.index_keycloak(iter_user_pages(get, f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users', PREFLIGHT_PAGE_SIZE, PREFLIGHT_WORKERS))
+        print(f'Pre-flight: {existing} Keycloak users indexed, {len(preflight.existing_user_ids)} with a Firebase userId')
+    finally:
+        session.close()
+
+def resume_preflight(controller, tokens):
+    '''
+    Users whose create request was in flight when the run died are in Keycloak but not
+    in the journals. Index the realm's userIds so they are reported as processed
+    instead of being created a second time.
+    '''
+    preflight = Preflight()
+    preflight.total_records = 0
+    index_realm(preflight, controller, tokens)
+    # Only users the interrupted run created are routed, email conflicts still get their 409
+    preflight.existing_emails.clear()
+    return preflight
+
+def run_threads(users, controller, tokens, store, preflight, delta, first_thread=1):
+    '''
+    Process users with NUM_THREADS UserProcessor threads, numbered from `first_thread`.
+    Returns the number of users read and the (opened, reused) connection counts.
+    '''
+    threads = []
+    # One connection per thread so every thread can keep its connection alive
+    session = create_session(NUM_THREADS)
+    # Shared bounded queue, so an idle thread always picks up the next record
+    user_queue = queue.Queue(maxsize=QUEUE_SIZE * NUM_THREADS)
+
+    # Start threads for processing user data
+    for i in range(NUM_THREADS):
+        thread = UserProcessor(first_thread + i, iter(user_queue.get, None), session, controller, tokens, store, preflight, delta)
+        threads.append(thread)
+        thread.start()
+
+    # Feed records to the threads as they are read from the dump
+    total_users = 0
+    try:
+        for user in users:
+            user_queue.put(user)
+            total_users += 1
+    finally:
+        # Signal end of data to every thread, also when reading the dump failed
+        for _ in threads:
+            user_queue.put(None)
 
         # This waits until all threads are completed
         for thread in threads:
             thread.join()
+
+    for thread in threads:
+        print(f'Thread {thread.thread_num}: {thread.records_processed} records in {thread.elapsed:.2f} seconds ({thread.throughput():.2f} records/sec)')
+
+    opened, reused = connection_stats(session)
+    session.close()
+    return total_users, opened, reused
+
+def run_engine(users, controller, tokens, store, preflight, delta, first_thread=1):
+    '''
+    Process users with the configured engine.
+    Returns the number of users read and the (opened, reused) connection counts.
+    '''
+    if ENGINE == 'async':
+        # Single event loop with bounded in-flight requests
+        processor = AsyncUserProcessor(first_thread, users, controller, tokens, store, preflight, delta)
+        processor.run()
+        return processor.total_users, processor.connections_opened, processor.connections_reused
+    return run_threads(users, controller, tokens, store, preflight, delta, first_thread)
+
+def create_tokens():
+    '''
+    Refresh the admin token with client credentials when available, else use the static token
+    '''
+    return create_token_manager(KEYCLOAK_URL, REALM_NAME, os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'),
+                                ADMIN_TOKEN, REQUEST_TIMEOUT, TOKEN_REFRESH_MARGIN)
+
+def create_controller():
+    # Concurrency is capped by the engine's worker count and adapted below it
+    max_concurrency = MAX_IN_FLIGHT if ENGINE == 'async' else NUM_THREADS
+    return AdaptiveController(max_concurrency, INITIAL_CONCURRENCY, LATENCY_TARGET, MAX_RETRIES, BACKOFF_BASE, BACKOFF_MAX, metrics)
+
+# (in flight, concurrency limit) last reported by each worker process
+worker_gauges = {}
+
+def run_worker(process_num, user_queue, outcome_queue, preflight, delta):
+    '''
+    Entry point of a worker process. Migrates the users routed to it with the configured
+    engine and its own connections, token and concurrency controller, and sends outcomes,
+    latencies and final counters to the main process over `outcome_queue`.
+    '''
+    global metrics, worker_process
+    worker_process = process_num
+    # The forked copy of the main process' metrics may hold a lock taken by its reporter
+    metrics = Metrics()
+    tokens = create_tokens()
+    controller = create_controller()
+    store = OutcomeSender(outcome_queue)
+
+    def send_stats():
+        outcome_queue.put(('stats', process_num, metrics.latency.drain(), controller.in_flight, int(controller.limit)))
+
+    stop = threading.Event()
+    def report():
+        while not stop.wait(min(PROGRESS_INTERVAL, 1.0)):
+            send_stats()
+    reporter = threading.Thread(target=report, daemon=True)
+    reporter.start()
+
+    # Thread numbers, and so report file names, do not overlap between processes
+    first_thread = (process_num - 1) * (1 if ENGINE == 'async' else NUM_THREADS) + 1
+    total_users, opened, reused = run_engine(iter(user_queue.get, None), controller, tokens, store, preflight, delta, first_thread)
+
+    stop.set()
+    reporter.join()
+    store.close()
+    if log_writer:
+        log_writer.close()
+    send_stats()
+    outcome_queue.put(('done', process_num, {
+        'users': total_users,
+        'opened': opened,
+        'reused': reused,
+        'requests': controller.requests,
+        'retries': controller.retries,
+        'decreases': controller.decreases,
+        'limit': controller.limit,
+        'refreshes': tokens.refreshes,
+        'provider_paths': dict(provider_paths),
+        'delta': dict(delta.counts) if delta else {},
+        'routed': dict(preflight.routed) if preflight else {},
+    }))
+
+def start_workers(preflight, delta):
+    '''
+    Fork WORKER_PROCESSES worker processes, each reading users from its own bounded queue.
+    Called before the run store, metrics reporter and log writer start their threads, so
+    no process is forked while another thread may hold a lock it inherits.
+    Returns the (processes, user queues, outcome queue) for `run_processes`.
+    '''
+    # Forked workers inherit the pre-flight indexes and delta settings without copying them
+    context = multiprocessing.get_context('fork')
+    outcome_queue = context.Queue()
+    user_queues = [context.Queue(maxsize=QUEUE_SIZE * NUM_THREADS) for _ in range(WORKER_PROCESSES)]
+    processes = [
+        context.Process(target=run_worker, args=(i + 1, user_queues[i], outcome_queue, preflight, delta), daemon=True)
+        for i in range(WORKER_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    return processes, user_queues, outcome_queue
+
+def run_processes(workers, users, controller, tokens, store, preflight, delta):
+    '''
+    Stream users to the worker processes of `start_workers` and collect their outcomes into
+    the run's store and metrics. Users are routed by a hash of their localId so repeated records
+    of a user meet in the same process. The workers' counters are added to `controller`,
+    `tokens`, `preflight` and `delta` for the summary.
+    Returns the number of users read and the (opened, reused) connection counts.
+    '''
+    processes, user_queues, outcome_queue = workers
+    summaries = {}
+    def collect():
+        while len(summaries) < WORKER_PROCESSES:
+            try:
+                message = outcome_queue.get(timeout=1)
+            except queue.Empty:
+                for i, process in enumerate(processes):
+                    if not process.is_alive() and i + 1 not in summaries:
+                        print(f'Worker process {i + 1} exited with code {process.exitcode} before finishing')
+                        summaries[i + 1] = None
+                continue
+            if message[0] == 'outcomes':
+                for row in message[1]:
+                    store.add(row)
+                    metrics.record_outcome(row[1], row[2])
+            elif message[0] == 'stats':
+                _, process_num, latency, in_flight, limit = message
+                metrics.latency.merge(*latency)
+                worker_gauges[process_num] = (in_flight, limit)
+            elif message[0] == 'done':
+                summaries[message[1]] = message[2]
+    # Daemon, so an interrupted run never waits on it at exit
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+
+    total_users = 0
+    try:
+        for user in users:
+            i = worker_of(user.get('localId') or '', WORKER_PROCESSES)
+            put_user(user_queues[i], processes[i], user)
+            total_users += 1
+    finally:
+        # Signal end of data to every live process, also when a worker died or reading failed,
+        # so the others finish their queues and the collector sees every process end
+        for user_queue, process in zip(user_queues, processes):
+            try:
+                put_user(user_queue, process, None)
+            except RuntimeError:
+                pass
+        for process in processes:
+            process.join()
+        # Every worker has exited, so the collector stops once the queue is drained
+        collector.join()
+
+    opened = reused = 0
+    controller.limit = 0
+    for summary in summaries.values():
+        if summary is None:
+            continue
+        opened += summary['opened']
+        reused += summary['reused']
+        controller.requests += summary['requests']
+        controller.retries += summary['retries']
+        controller.decreases += summary['decreases']
+        controller.limit += summary['limit']
+        tokens.refreshes += summary['refreshes']
+        provider_paths.update(summary['provider_paths'])
+        if delta:
+            delta.counts.update(summary['delta'])
+        if preflight:
+            preflight.routed.update(summary['routed'])
+    return total_users, opened, reused
+
+def put_user(user_queue, process, user):
+    '''
+    Hand a user to a worker process, failing instead of blocking forever if it died
+    '''
+    while True:
+        try:
+            user_queue.put(user, timeout=1)
+            return
+        except queue.Full:
+            if not process.is_alive():
+                raise RuntimeError(f'Worker process exited with code {process.exitcode}')
+
+def parse_shard(value):
+    '''
+    Parse `--shard I/N` into a 0-based shard index and the shard count
+    '''
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected I/N, got {value}')
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'shard {index} is not between 1 and {count}')
+    return index - 1, count
+
+def main():
+    global log_folder
+    parser = argparse.ArgumentParser(description='Migrate Firebase users to Keycloak')
+    parser.add_argument('--resume', metavar='LOGS_DIR', help='Continue an interrupted run, skipping users already completed in LOGS_DIR')
+    parser.add_argument('--compiled', metavar='DIR', help='Send the payload shards written by compile-users.py instead of reading USER_DUMP_FILE')
+    parser.add_argument('--shard', metavar='I/N', type=parse_shard, help='Only migrate the users whose localId hashes to shard I of N (1 <= I <= N)')
+    parser.add_argument('--delta', metavar='PREVIOUS_LOGS_DIR', help='Only create new users and update users changed since the run in PREVIOUS_LOGS_DIR')
+    parser.add_argument('--retry', metavar='LOGS_DIR', help='Only migrate the users that failed or were left unprocessed in LOGS_DIR, read from the dump through its byte-offset index')
+    parser.add_argument('--validate', action='store_true', help='Validate records like split-records.py in the same pass, writing filtered_records.ndjson and skipped_records.ndjson to the log folder')
+    parser.add_argument('--run-id', help='Name the log folder logs_<RUN_ID> (default: RUN_ID, else a timestamp-based ID)')
+    args = parser.parse_args()
+    if args.run_id:
+        log_folder = os.getenv('LOG_FILE_PATH', 'Log') + f'logs_{args.run_id}'
+    if args.shard:
+        log_folder = os.path.join(log_folder, f'shard_{args.shard[0] + 1}_of_{args.shard[1]}')
+    if args.validate and args.compiled:
+        parser.error('--validate reads the Firebase records and cannot be combined with --compiled')
+
+    # Script execution starts here
+    start_time = time.time() # Record the start time
+    # Failed and unprocessed users of the earlier run, located in the dump by offset
+    if args.retry:
+        if args.compiled:
+            parser.error('--retry reads USER_DUMP_FILE and cannot be combined with --compiled')
+        dump_file = os.getenv('USER_DUMP_FILE')
+        try:
+            dump_index = open_index(dump_file, DUMP_INDEX_FILE)
+        except (OSError, ValueError) as e:
+            parser.error(f'Cannot index {dump_file}: {e}')
+        spans, missing = dump_index.locate(retry_ids(args.retry.rstrip('/')))
+        print(f'Retrying {len(spans)} failed and unprocessed users of {args.retry}' + (f', {len(missing)} not found in the dump' if missing else ''))
+
+    def read_users():
+        if args.retry:
+            return load_indexed_users(dump_index, spans)
+        if args.compiled:
+            return load_compiled_users(args.compiled, NUM_USERS_TO_PROCESS)
+        return load_users(os.getenv('USER_DUMP_FILE'), NUM_USERS_TO_PROCESS)
+    users = read_users()
+    if args.shard:
+        # Every node streams the whole dump and keeps its own shard
+        users = iter_shard(users, *args.shard)
+        print(f'Migrating shard {args.shard[0] + 1} of {args.shard[1]} into {log_folder}')
+    completed_ids = set()
+
+    if args.resume:
+        # Continue in the interrupted run's folder, without sending requests for completed users
+        log_folder = args.resume.rstrip('/')
+        completed_ids = prepare_resume(log_folder)
+        print(f'Resuming run in {log_folder}, skipping {len(completed_ids)} completed users')
+        users = (user for user in users if user['localId'] not in completed_ids)
+
+    # Recently active users first, so their logins can move to Keycloak early
+    scheduler = None
+    if SCHEDULE != 'dump':
+        if SCHEDULE not in SCHEDULES:
+            parser.error(f'SCHEDULE must be one of {", ".join(SCHEDULES)}, got {SCHEDULE}')
+        scheduler = Scheduler(SCHEDULE, SCHEDULE_BUFFER, SCHEDULE_TMP_DIR, ACTIVE_DAYS, RECENT_DAYS)
+        users = scheduler.schedule(users)
+
+    # Fingerprints of the users the previous run migrated
+    delta = None
+    if args.delta:
+        try:
+            delta = DeltaSync(args.delta.rstrip('/'))
+        except ValueError as e:
+            parser.error(str(e))
+
+    tokens = create_tokens()
+    controller = create_controller()
+    # Extra pass over the dump and the realm so known conflicts cost no request
+    if PREFLIGHT:
+        # Records the validation stage drops are counted but must not claim emails or phone numbers
+        dump_users = read_users()
+        if args.validate:
+            dump_users = (user if validate_record(user) is None else {'localId': user['localId'], 'kind': INVALID_USER} for user in dump_users)
+        preflight = run_preflight(dump_users, controller, tokens)
+    elif args.resume:
+        preflight = resume_preflight(controller, tokens)
     else:
+        preflight = None
+
+    # Worker processes are forked before any background thread of this process starts
+    workers = start_workers(preflight, delta) if WORKER_PROCESSES > 1 else None
+
+    # Outcome database for status_counts.py and the analysis scripts
+    os.makedirs(log_folder, exist_ok=True)
+    store = RunStore(log_folder)
+
+    # Single pass: read -> validate and build payloads -> send and record, over bounded queues
+    validation = None
+    if args.validate:
+        validation = collections.Counter()
+        users = staged(validate_users(staged(users, QUEUE_SIZE * NUM_THREADS), store, validation), QUEUE_SIZE * NUM_THREADS)
+
+    # Periodic progress line and Prometheus metrics, also served over HTTP when METRICS_PORT is set
+    if WORKER_PROCESSES > 1:
+        metrics.add_gauge('requests_in_flight', 'Keycloak requests in flight.', lambda: sum(gauge[0] for gauge in list(worker_gauges.values())))
+        metrics.add_gauge('concurrency_limit', 'Current limit on in-flight Keycloak requests.', lambda: sum(gauge[1] for gauge in list(worker_gauges.values())))
+    else:
+        metrics.add_gauge('requests_in_flight', 'Keycloak requests in flight.', lambda: controller.in_flight)
+        metrics.add_gauge('concurrency_limit', 'Current limit on in-flight Keycloak requests.', lambda: int(controller.limit))
+    metrics_file = os.path.join(log_folder, 'metrics.prom')
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    # Users expected in this run, for the ETA, when the dump size is known
+    total_expected = NUM_USERS_TO_PROCESS or (preflight.total_records if preflight else 0)
+    if args.retry:
+        total_expected = len(spans)
+    if args.shard:
+        total_expected //= args.shard[1]
+    metrics.start_reporting(PROGRESS_INTERVAL, metrics_file, max(total_expected - len(completed_ids), 0))
+
+    try:
+        if workers:
+            total_users, opened, reused = run_processes(workers, users, controller, tokens, store, preflight, delta)
+        else:
+            total_users, opened, reused = run_engine(users, controller, tokens, store, preflight, delta)
+    finally:
+        # Outcomes recorded before a failure are still written
+        metrics.stop_reporting(metrics_file)
+        store.close()
+        if log_writer:
+            log_writer.close()
+    if not total_users:
         logging.warning('No users data found.')
 
     end_time = time.time() # Record the end time
     total_time = end_time - start_time
     print(f"Total time taken: {total_time} seconds")
+    print(f"Connections opened: {opened}, reused: {reused}")
+    print(f"Requests: {controller.requests}, retries: {controller.retries}, concurrency reductions: {controller.decreases}, final concurrency: {int(controller.limit)}")
+    print(f"Admin token refreshes: {tokens.refreshes}")
+    print(f"Request latency: {metrics.latency_summary()}")
+    for (status, kind), count in sorted(metrics.outcomes.items(), key=str):
+        print(f"- {status} {kind} users: {count}")
+    if provider_paths:
+        print(f"Provider users linked in the create request: {provider_paths['embedded']}, in separate requests: {provider_paths['two-step']}")
+    if delta:
+        print(f"Delta sync: {delta.counts['new']} new, {delta.counts['changed']} changed, {delta.counts['unchanged']} unchanged users")
+    if validation is not None:
+        print(f"Validated {validation['valid'] + validation['invalid']} records: {validation['valid']} valid, "
+              f"{validation['invalid']} skipped with reasons in {log_folder}/skipped_records.ndjson")
+    if scheduler:
+        print("Scheduled users: " + ", ".join(f"{name} {scheduler.tiers[name]}" for name in TIER_NAMES))
+    if preflight:
+        print(f"Requests avoided by pre-flight: {preflight.routed['processed']} existing users, {preflight.routed['skipped']} conflicts")
+    print(f"Throughput: {total_users / total_time if total_time else 0:.2f} users/sec")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,54 @@
+import collections
+import os
+import sqlite3
+import threading
+
+from run_store import DB_NAME, processed_fingerprint
+from user_payloads import fingerprint
+
+# How a user compares with the previous run
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+class DeltaSync:
+    '''
+    Compares users with the fingerprints a previous run recorded for the users it
+    migrated. Each worker thread queries the previous run's database on its own
+    read-only connection, so the fingerprints are never loaded into memory.
+    '''
+    def __init__(self, previous_folder):
+        self.db_path = os.path.join(previous_folder, DB_NAME)
+        if not os.path.exists(self.db_path):
+            raise ValueError(f'No outcome database in {previous_folder}')
+        conn = self.connect()
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(outcomes)')]
+        conn.close()
+        if 'fingerprint' not in columns:
+            raise ValueError(f'The run in {previous_folder} did not record user fingerprints')
+        self.local = threading.local()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+
+    def compare(self, user):
+        '''
+        Return NEW, CHANGED or UNCHANGED for a raw or compiled user
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        previous = processed_fingerprint(conn, user['localId'])
+        current = user['fingerprint'] if 'fingerprint' in user else fingerprint(user)
+        if previous is None:
+            change = NEW
+        elif previous == current:
+            change = UNCHANGED
+        else:
+            change = CHANGED
+        with self.lock:
+            self.counts[change] += 1
+        return change
@@ -0,0 +1,120 @@
+import json
+import mmap
+import os
+import sqlite3
+
+from user_stream import iter_spans
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    local_id TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dump (
+    path TEXT,
+    size INTEGER,
+    mtime REAL
+);
+'''
+
+# Rows inserted per transaction while indexing
+BATCH_SIZE = 10000
+
+
+def default_index_path(dump_path):
+    return f'{dump_path}.index.db'
+
+
+def dump_signature(dump_path):
+    stat = os.stat(dump_path)
+    return stat.st_size, stat.st_mtime
+
+
+def build_index(dump_path, index_path):
+    '''
+    Stream the dump once and store the byte offset and length of every user record
+    by localId. Returns the (records indexed, repeated localIds) counts.
+    '''
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    conn = sqlite3.connect(index_path)
+    conn.executescript(SCHEMA)
+    seen = indexed = 0
+    batch = []
+
+    def flush():
+        # The first record of a repeated localId is kept
+        inserted = conn.executemany('INSERT OR IGNORE INTO records VALUES (?, ?, ?)', batch).rowcount
+        conn.commit()
+        batch.clear()
+        return inserted
+
+    for span in iter_spans(dump_path):
+        batch.append(span)
+        seen += 1
+        if len(batch) >= BATCH_SIZE:
+            indexed += flush()
+    indexed += flush()
+
+    conn.execute('INSERT INTO dump VALUES (?, ?, ?)', (os.path.abspath(dump_path), *dump_signature(dump_path)))
+    conn.commit()
+    conn.close()
+    return indexed, seen - indexed
+
+
+class DumpIndex:
+    '''
+    Reads individual user records from a dump through its byte-offset index,
+    so loading a few records costs a few index lookups and page reads however large the dump is
+    '''
+    def __init__(self, dump_path, index_path):
+        self.dump_path = dump_path
+        self.conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        row = self.conn.execute('SELECT size, mtime FROM dump').fetchone()
+        if row is None or tuple(row) != dump_signature(dump_path):
+            self.conn.close()
+            raise ValueError(f'{index_path} does not match {dump_path}, rebuild it with index-dump.py')
+
+    def locate(self, local_ids):
+        '''
+        (offset, length) of the given users in dump order, and the ids missing from the dump
+        '''
+        spans = []
+        missing = []
+        for local_id in local_ids:
+            row = self.conn.execute('SELECT offset, length FROM records WHERE local_id = ?', (local_id,)).fetchone()
+            if row:
+                spans.append(row)
+            else:
+                missing.append(local_id)
+        spans.sort()
+        return spans, missing
+
+    def iter_records(self, spans):
+        '''
+        Yield the user records at the given spans
+        '''
+        if not spans:
+            return
+        with open(self.dump_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, length in spans:
+                yield json.loads(data[offset:offset + length])
+
+    def close(self):
+        self.conn.close()
+
+
+def open_index(dump_path, index_path=None):
+    '''
+    Open the index of a dump, building it first when it is missing or out of date
+    '''
+    index_path = index_path or default_index_path(dump_path)
+    if os.path.exists(index_path):
+        try:
+            return DumpIndex(dump_path, index_path)
+        except (ValueError, sqlite3.DatabaseError):
+            pass
+    indexed, repeated = build_index(dump_path, index_path)
+    print(f'Indexed {indexed} users of {dump_path} into {index_path}' + (f', {repeated} repeated localIds' if repeated else ''))
+    return DumpIndex(dump_path, index_path)
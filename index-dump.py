@@ -0,0 +1,24 @@
+import argparse, dotenv, os, time
+
+from dump_index import build_index, default_index_path
+
+# Load environment variables
+dotenv.load_dotenv()
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the byte offset of every user record in a Firebase dump, for create-users.py --retry')
+    parser.add_argument('--dump', default=os.getenv('USER_DUMP_FILE'), help='Uncompressed Firebase user dump (default: USER_DUMP_FILE)')
+    parser.add_argument('--output', default=os.getenv('DUMP_INDEX_FILE'), help='Index database (default: DUMP_INDEX_FILE, else <dump>.index.db)')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    index_path = args.output or default_index_path(args.dump)
+    indexed, repeated = build_index(args.dump, index_path)
+    total_time = time.time() - start_time
+    print(f'Indexed {indexed} users of {args.dump} into {index_path}')
+    if repeated:
+        print(f'{repeated} repeated localIds point to their first record')
+    print(f'Total time taken: {total_time:.2f} seconds')
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
-import json
+import sys
 
-# Load the JSON file
-with open('filtered_records.json', 'r') as file:
-    data = json.load(file)
-    users_data = data['users'] if isinstance(data, dict) and 'users' in data else data
+from user_stream import is_ndjson, iter_users, open_dump
 
-# Count the number of records
-record_count = len(users_data)
+# Count the records of filtered_records.ndjson, or of the JSON/NDJSON file given as argument
+file_path = sys.argv[1] if len(sys.argv) > 1 else 'filtered_records.ndjson'
+if is_ndjson(file_path):
+    # One record per line, no need to parse them
+    with open_dump(file_path) as file:
+        record_count = sum(1 for line in file if line.strip())
+else:
+    record_count = sum(1 for _ in iter_users(file_path))
 
 print(f'Total number of records: {record_count}')
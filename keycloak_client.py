@@ -0,0 +1,329 @@
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(pool_size):
+    '''
+    Create a requests session that keeps up to `pool_size` connections alive per host.
+    The session is shared by all worker threads, so the pool blocks instead of
+    opening throwaway connections when every connection is busy.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_client_token(keycloak_url, realm_name, client_id, client_secret, timeout):
+    '''
+    Get an admin token with the client credentials grant, or None when it cannot be obtained
+    '''
+    token_url = f'{keycloak_url}/realms/{realm_name}/protocol/openid-connect/token'
+    payload = {
+        'grant_type': 'client_credentials',
+        'client_id': client_id,
+        'client_secret': client_secret
+    }
+    try:
+        response = requests.post(token_url, data=payload, timeout=timeout)
+        if response.status_code == 200:
+            return response.json().get('access_token')
+        print(f"Failed to obtain admin token: {response.text}")
+        return None
+    except Exception as e:
+        print(f"Error obtaining admin token: {e}")
+        return None
+
+
+def connection_stats(session):
+    '''
+    Return (opened, reused) connection counts across the session's connection pools
+    '''
+    opened = 0
+    requests_sent = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+    return opened, max(requests_sent - opened, 0)
+
+
+# Responses that mean Keycloak is overloaded or briefly unavailable
+TRANSIENT_STATUSES = (429, 502, 503, 504)
+
+
+class AdaptiveController:
+    '''
+    Shared AIMD limit on in-flight Keycloak requests with retries for transient failures.
+    The limit grows by one request per window of successful responses and is halved,
+    at most once per observed latency, when Keycloak answers 429/5xx, drops the
+    connection, or the smoothed latency exceeds `latency_target` seconds.
+    The latency of every attempt is also passed to `metrics.observe` when given.
+    '''
+    def __init__(self, max_limit, initial_limit, latency_target, max_retries, backoff_base, backoff_max, metrics=None):
+        self.max_limit = max_limit
+        self.limit = float(max(1, min(initial_limit, max_limit)))
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = metrics
+        self.cond = threading.Condition()
+        self.async_cond = None
+        self.in_flight = 0
+        self.latency = None
+        self.last_decrease = 0.0
+        # Counters for the run summary
+        self.requests = 0
+        self.retries = 0
+        self.decreases = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    async def acquire_async(self):
+        # Created lazily so it belongs to the running event loop
+        if self.async_cond is None:
+            self.async_cond = asyncio.Condition()
+        async with self.async_cond:
+            await self.async_cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release_async(self):
+        async with self.async_cond:
+            self.in_flight -= 1
+            self.async_cond.notify_all()
+
+    def record(self, latency, overloaded):
+        '''
+        Adjust the limit after a response (or connection failure) that took `latency` seconds
+        '''
+        with self.cond:
+            self.requests += 1
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            now = time.monotonic()
+            if overloaded or self.latency > self.latency_target:
+                # Multiplicative decrease, once per round trip so one burst counts once
+                if now - self.last_decrease > self.latency:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+                    self.decreases += 1
+            else:
+                # Additive increase of one request per limit's worth of responses
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def backoff(self, attempt, response):
+        '''
+        Seconds to wait before retry `attempt`, honouring Retry-After when Keycloak sends it
+        '''
+        with self.cond:
+            self.retries += 1
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, send, weight=1):
+        '''
+        Call `send()` under the concurrency limit and return its response,
+        retrying transient failures. Raises the last connection error if every attempt failed.
+        Requests carrying `weight` users (bulk imports) are judged on latency per user.
+        '''
+        attempt = 0
+        while True:
+            response, error = None, None
+            self.acquire()
+            start = time.monotonic()
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.release()
+            latency = time.monotonic() - start
+            if self.metrics:
+                self.metrics.observe(latency)
+            transient = response is None or response.status_code in TRANSIENT_STATUSES
+            self.record(latency / weight, transient)
+            if not transient or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+            time.sleep(self.backoff(attempt, response))
+
+    async def request_async(self, send, connection_errors):
+        '''
+        Async variant of `request` for a coroutine function `send`.
+        `connection_errors` are the exception types treated as transient.
+        '''
+        attempt = 0
+        while True:
+            response, error = None, None
+            await self.acquire_async()
+            start = time.monotonic()
+            try:
+                response = await send()
+            except connection_errors as e:
+                error = e
+            finally:
+                await self.release_async()
+            latency = time.monotonic() - start
+            if self.metrics:
+                self.metrics.observe(latency)
+            transient = response is None or response.status_code in TRANSIENT_STATUSES
+            self.record(latency, transient)
+            if not transient or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+            await asyncio.sleep(self.backoff(attempt, response))
+
+
+def token_expiry(token, default_ttl=60):
+    '''
+    Read the `exp` claim of a JWT access token without verifying it.
+    Falls back to `default_ttl` seconds from now when the token cannot be decoded.
+    '''
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return time.time() + default_ttl
+
+
+class TokenManager:
+    '''
+    Shared admin token that is refreshed `refresh_margin` seconds before it expires, or
+    halfway through its lifetime when that is shorter than twice the margin.
+    Only one caller refreshes at a time; the others wait for and reuse its token.
+    Without `fetch_token` the initial static token is used as is.
+    '''
+    def __init__(self, fetch_token, token=None, refresh_margin=60, retry_delay=5):
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.token = token
+        self.expires_at = 0.0
+        self.margin = 0.0
+        if token:
+            self.set_token(token)
+        self.retry_delay = retry_delay
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+        self.async_lock = None
+        self.refreshes = 0
+
+    def needs_refresh(self):
+        if self.fetch_token is None:
+            return False
+        now = time.time()
+        return now >= self.expires_at - self.margin and now >= self.retry_at
+
+    def set_token(self, token):
+        self.token = token
+        self.expires_at = token_expiry(token)
+        # A margin as long as the token's lifetime would refresh it on every request
+        self.margin = max(0.0, min(self.refresh_margin, (self.expires_at - time.time()) / 2))
+
+    def get(self):
+        if not self.needs_refresh():
+            return self.token
+        with self.lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self.needs_refresh():
+                self.refresh()
+            return self.token
+
+    async def get_async(self):
+        if not self.needs_refresh():
+            return self.token
+        # Created lazily so it belongs to the running event loop
+        if self.async_lock is None:
+            self.async_lock = asyncio.Lock()
+        async with self.async_lock:
+            if self.needs_refresh():
+                await asyncio.get_event_loop().run_in_executor(None, self.get)
+            return self.token
+
+    def refresh(self):
+        token = self.fetch_token()
+        if token:
+            self.set_token(token)
+            self.refreshes += 1
+        else:
+            # Keep the old token and give the token endpoint a moment before trying again
+            self.retry_at = time.time() + self.retry_delay
+
+    def invalidate(self, token):
+        '''
+        Force a refresh after `token` was rejected, unless it was already replaced.
+        Returns False when the token cannot be refreshed, so there is no point replaying.
+        '''
+        with self.lock:
+            if token == self.token:
+                self.expires_at = 0.0
+                self.retry_at = 0.0
+        return self.fetch_token is not None
+
+
+def create_token_manager(keycloak_url, realm_name, client_id, client_secret, admin_token, timeout, refresh_margin=60):
+    '''
+    Admin tokens from the client credentials grant when CLIENT_ID and CLIENT_SECRET are
+    set, else the static `admin_token` used as is
+    '''
+    if client_id and client_secret:
+        return TokenManager(lambda: get_client_token(keycloak_url, realm_name, client_id, client_secret, timeout),
+                            admin_token, refresh_margin)
+    return TokenManager(None, admin_token)
+
+
+def admin_get(session, controller, tokens, timeout):
+    '''
+    Return `get(url)`, an authenticated admin API GET through `controller`
+    '''
+    def get(url):
+        return controller.request(lambda: session.get(url, headers={'Authorization': f'Bearer {tokens.get()}'}, timeout=timeout))
+    return get
+
+
+def iter_user_pages(get, users_url, page_size, workers):
+    '''
+    Page through a realm's users with full representations, `workers` pages at a time,
+    and yield the pages in order. `get(url)` returns a requests-like response.
+    '''
+    response = get(f'{users_url}/count')
+    response.raise_for_status()
+    total = int(response.text)
+
+    def fetch_page(first):
+        response = get(f'{users_url}?first={first}&max={page_size}&briefRepresentation=false')
+        response.raise_for_status()
+        return response.json()
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        yield from pool.map(fetch_page, range(0, total, page_size))
@@ -0,0 +1,48 @@
+import argparse
+import glob
+import os
+import re
+import shutil
+
+from run_store import merge_stores
+
+# Per-thread report files, named <prefix>_thread_<n><extension>
+THREAD_FILE = re.compile(r'^(.+)_thread_(\d+)(\.json|\.ndjson)$')
+
+def merge_runs(run_folder, shard_folders):
+    '''
+    Combine the reports of the shard folders of a run into `run_folder`. Per-thread files
+    are renumbered so threads of different shards do not collide, and the outcome
+    databases are merged, so the report scripts can be pointed at `run_folder`.
+    '''
+    os.makedirs(run_folder, exist_ok=True)
+    next_thread = 1
+    for shard_folder in shard_folders:
+        # Thread numbers of this shard -> thread numbers in the merged folder
+        threads = {}
+        for file_name in sorted(os.listdir(shard_folder)):
+            match = THREAD_FILE.match(file_name)
+            if not match:
+                continue
+            prefix, thread_num, extension = match.groups()
+            if thread_num not in threads:
+                threads[thread_num] = next_thread
+                next_thread += 1
+            target = os.path.join(run_folder, f'{prefix}_thread_{threads[thread_num]}{extension}')
+            shutil.copyfile(os.path.join(shard_folder, file_name), target)
+        print(f'{shard_folder}: {len(threads)} threads')
+    outcomes = merge_stores(run_folder, shard_folders)
+    print(f'Merged {len(shard_folders)} shards into {run_folder} ({outcomes} user outcomes)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the shard outputs of a sharded migration run')
+    parser.add_argument('run_folder', help='Folder to write the merged reports to, usually LOG/logs_<run id>')
+    parser.add_argument('shard_folders', nargs='*', help='Shard folders to merge (default: the shard_* folders in run_folder)')
+    args = parser.parse_args()
+    shard_folders = args.shard_folders or sorted(glob.glob(os.path.join(args.run_folder, 'shard_*')))
+    if not shard_folders:
+        parser.error(f'No shard folders found in {args.run_folder}')
+    merge_runs(args.run_folder, shard_folders)
+
+if __name__ == "__main__":
+    main()
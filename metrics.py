@@ -0,0 +1,208 @@
+import bisect
+import collections
+import os
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets, 10% apart from 1 ms to about 2 minutes
+LATENCY_BUCKETS = tuple(0.001 * 1.1 ** i for i in range(123))
+
+# Outcome statuses shown in the progress line
+STATUSES = ('processed', 'failed', 'skipped', 'unprocessed')
+
+
+class Histogram:
+    '''
+    Fixed-bucket latency histogram. Percentiles are interpolated within a bucket,
+    so they are accurate to the 10% bucket width whatever the number of requests.
+    '''
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def drain(self):
+        '''
+        Return the (counts, count, sum) observed since the last drain and reset them
+        '''
+        with self.lock:
+            observed = (self.counts, self.count, self.sum)
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+        return observed
+
+    def merge(self, counts, count, total):
+        '''
+        Add observations drained from a histogram with the same buckets
+        '''
+        with self.lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.count += count
+            self.sum += total
+
+    def percentile(self, q):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q / 100 * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.bounds[-1]
+
+
+class Metrics:
+    '''
+    Counters per outcome and user kind, an HTTP latency histogram and gauges
+    read at report time, shown as a progress line and in Prometheus text format
+    '''
+    def __init__(self):
+        self.start_time = time.time()
+        self.outcomes = collections.Counter()
+        self.latency = Histogram()
+        # name -> (help, function returning the current value)
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.reporter = None
+
+    def record_outcome(self, status, kind):
+        with self.lock:
+            self.outcomes[status, kind] += 1
+
+    def observe(self, latency):
+        self.latency.observe(latency)
+
+    def add_gauge(self, name, help_text, read):
+        self.gauges[name] = (help_text, read)
+
+    def status_counts(self):
+        with self.lock:
+            outcomes = dict(self.outcomes)
+        counts = collections.Counter()
+        for (status, _), count in outcomes.items():
+            counts[status] += count
+        return counts
+
+    def progress_line(self, total=None):
+        counts = self.status_counts()
+        done = sum(counts.values())
+        elapsed = time.time() - self.start_time
+        rate = done / elapsed if elapsed else 0.0
+        line = f'Progress: {done}'
+        if total:
+            line += f'/{total} users ({done / total * 100:.1f}%)'
+            if rate:
+                line += f', ETA {timedelta(seconds=int(max(total - done, 0) / rate))}'
+        else:
+            line += ' users'
+        line += f' | {rate:.2f} users/sec | ' + ', '.join(f'{status} {counts[status]}' for status in STATUSES)
+        line += f' | p95 latency {self.latency.percentile(95):.3f}s'
+        for name, (_, read) in self.gauges.items():
+            line += f' | {name} {read():g}'
+        return line
+
+    def latency_summary(self):
+        return ', '.join(f'p{q} {self.latency.percentile(q):.3f}s' for q in (50, 95, 99))
+
+    def render(self):
+        '''
+        Current metrics in the Prometheus text exposition format
+        '''
+        with self.lock:
+            outcomes = dict(self.outcomes)
+        lines = [
+            '# HELP migration_users_total Users migrated, by outcome and user kind.',
+            '# TYPE migration_users_total counter',
+        ]
+        for (status, kind), count in sorted(outcomes.items(), key=str):
+            lines.append(f'migration_users_total{{status="{status}",kind="{kind}"}} {count}')
+
+        with self.latency.lock:
+            counts = list(self.latency.counts)
+            total, latency_sum = self.latency.count, self.latency.sum
+        lines += [
+            '# HELP migration_request_duration_seconds Keycloak request latency.',
+            '# TYPE migration_request_duration_seconds histogram',
+        ]
+        cumulative = 0
+        for bound, count in zip(self.latency.bounds, counts):
+            cumulative += count
+            lines.append(f'migration_request_duration_seconds_bucket{{le="{bound:.4g}"}} {cumulative}')
+        lines.append(f'migration_request_duration_seconds_bucket{{le="+Inf"}} {total}')
+        lines.append(f'migration_request_duration_seconds_sum {latency_sum}')
+        lines.append(f'migration_request_duration_seconds_count {total}')
+
+        for name, (help_text, read) in self.gauges.items():
+            metric = 'migration_' + name
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge', f'{metric} {read()}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_path):
+        # Replace the file in one step so scrapers never read a partial file
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(temp_path, file_path)
+
+    def start_reporting(self, interval, file_path, total=None):
+        '''
+        Print a progress line and rewrite the metrics file every `interval` seconds
+        '''
+        self.start_time = time.time()
+
+        def report():
+            while not self.stop_event.wait(interval):
+                print(self.progress_line(total), flush=True)
+                self.write(file_path)
+        self.reporter = threading.Thread(target=report, daemon=True)
+        self.reporter.start()
+
+    def stop_reporting(self, file_path):
+        self.stop_event.set()
+        if self.reporter:
+            self.reporter.join()
+        self.write(file_path)
+
+    def serve(self, port):
+        '''
+        Serve the metrics on http://0.0.0.0:`port`/metrics from a background thread
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,100 @@
+import collections
+import threading
+
+from run_store import DUPLICATE_ID
+from user_payloads import PHONE_USER, SKIPPED_KINDS, classify_user
+
+
+def normalize_email(email):
+    '''
+    Keycloak stores emails in lower case, so emails are compared the same way
+    '''
+    return email.strip().lower() if email else None
+
+
+class Preflight:
+    '''
+    Conflicts known before any user is sent: users whose localId already exists in
+    Keycloak (as the `userId` attribute), emails already used in Keycloak, and emails,
+    phone numbers and localIds that appear more than once in the dump, where the
+    first record in dump order wins.
+    '''
+    def __init__(self):
+        self.email_owners = {}
+        self.phone_owners = {}
+        self.repeated_ids = set()
+        self.existing_user_ids = set()
+        self.existing_emails = set()
+        # Repeated localIds already handed to a worker
+        self.claimed_ids = set()
+        self.lock = threading.Lock()
+        self.routed = collections.Counter()
+
+    def index_dump(self, users):
+        '''
+        Hash the localId, email and phone number of every record in one streaming pass
+        '''
+        seen_ids = set()
+        for user in users:
+            local_id = user['localId']
+            if local_id in seen_ids:
+                self.repeated_ids.add(local_id)
+            seen_ids.add(local_id)
+            kind = user['kind'] if 'kind' in user else classify_user(user)
+            if kind in SKIPPED_KINDS:
+                continue
+            email = normalize_email(user.get('email'))
+            if email:
+                self.email_owners.setdefault(email, local_id)
+            # Phone numbers are only unique logins for phone users
+            phone = user.get('phoneNumber')
+            if kind == PHONE_USER and phone:
+                self.phone_owners.setdefault(phone, local_id)
+        return len(seen_ids)
+
+    def index_keycloak(self, pages):
+        '''
+        Collect the emails and `userId` attributes of the realm's users from pages of
+        Keycloak users. Returns the number of users indexed.
+        '''
+        total = 0
+        for page in pages:
+            total += len(page)
+            for user in page:
+                email = normalize_email(user.get('email'))
+                if email:
+                    self.existing_emails.add(email)
+                self.existing_user_ids.update(user.get('attributes', {}).get('userId', []))
+        return total
+
+    def check(self, user, kind):
+        '''
+        Return (status, reason) for a user that must not be sent, or None.
+        Users already in Keycloak are reported as processed, other conflicts as skipped.
+        '''
+        local_id = user['localId']
+        conflict = None
+        if local_id in self.existing_user_ids:
+            conflict = ('processed', 'User already exists in Keycloak')
+        elif local_id in self.repeated_ids and not self.claim(local_id):
+            conflict = ('skipped', DUPLICATE_ID)
+        else:
+            email = normalize_email(user.get('email'))
+            phone = user.get('phoneNumber')
+            if email and email in self.existing_emails:
+                conflict = ('skipped', 'Email already used by another Keycloak user')
+            elif email and self.email_owners.get(email, local_id) != local_id:
+                conflict = ('skipped', f'Duplicate email of user {self.email_owners[email]}')
+            elif kind == PHONE_USER and phone and self.phone_owners.get(phone, local_id) != local_id:
+                conflict = ('skipped', f'Duplicate phone number of user {self.phone_owners[phone]}')
+        if conflict:
+            with self.lock:
+                self.routed[conflict[0]] += 1
+        return conflict
+
+    def claim(self, local_id):
+        with self.lock:
+            if local_id in self.claimed_ids:
+                return False
+            self.claimed_ids.add(local_id)
+            return True
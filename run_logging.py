@@ -0,0 +1,85 @@
+import contextvars
+import json
+import logging
+import queue
+import threading
+
+# Fields of Firebase records and Keycloak payloads that never reach the logs
+SENSITIVE_FIELDS = ('passwordHash', 'salt', 'credentials')
+
+# localId of the user being processed by the current thread or asyncio task
+current_user_id = contextvars.ContextVar('current_user_id', default=None)
+
+
+def redact(user):
+    '''
+    Copy of a user record or payload with its sensitive fields masked
+    '''
+    return {key: '[REDACTED]' if key in SENSITIVE_FIELDS else value for key, value in user.items()}
+
+
+class UserContextFilter(logging.Filter):
+    '''
+    Tag log records with the user being processed when they are emitted
+    '''
+    def filter(self, record):
+        record.localId = current_user_id.get()
+        return True
+
+
+class QueueLogHandler(logging.Handler):
+    '''
+    Hand log records to a LogWriter without formatting them on the worker
+    '''
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+
+    def emit(self, record):
+        self.writer.queue.put(record)
+
+
+class LogWriter:
+    '''
+    Background thread that formats queued log records as one compact JSON event per
+    line and writes them to a single file in batches of up to `batch_size` records
+    '''
+    def __init__(self, file_path, batch_size=1000):
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.file = open(file_path, 'a', buffering=1 << 20)
+        self.thread = threading.Thread(target=self.write_records, daemon=True)
+        self.thread.start()
+
+    def format(self, record):
+        event = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'thread': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'localId', None):
+            event['localId'] = record.localId
+        if record.exc_info:
+            event['error'] = logging.Formatter().formatException(record.exc_info)
+        return json.dumps(event, default=str) + '\n'
+
+    def write_records(self):
+        done = False
+        while not done:
+            records = [self.queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                records = [record for record in records if record is not None]
+                done = True
+            self.file.write(''.join(self.format(record) for record in records))
+            self.file.flush()
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+# Outcome database kept in each logs folder
+DB_NAME = 'run_report.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outcomes (
+    local_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    kind TEXT,
+    email TEXT,
+    error_class TEXT,
+    error TEXT,
+    http_status INTEGER,
+    latency REAL,
+    thread INTEGER,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS outcomes_status ON outcomes (status);
+CREATE INDEX IF NOT EXISTS outcomes_error_class ON outcomes (status, error_class);
+CREATE INDEX IF NOT EXISTS outcomes_kind ON outcomes (status, kind);
+'''
+
+# Later outcomes of a user (e.g. after --resume) replace earlier ones
+INSERT = 'INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+# Except the skip of a repeated dump record, which never hides the outcome of the copy that was sent
+INSERT_DUPLICATE = 'INSERT OR IGNORE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+# Reason recorded for the repeated records of a localId
+DUPLICATE_ID = 'Duplicate localId in dump'
+
+
+def error_class(error, response):
+    '''
+    Short, groupable description of why a user failed
+    '''
+    if response is not None and response.status_code >= 400:
+        try:
+            body = json.loads(response.text)
+            message = body.get('errorMessage') or body.get('error')
+        except (ValueError, AttributeError):
+            message = None
+        return f'HTTP {response.status_code}: {message}' if message else f'HTTP {response.status_code}'
+    if isinstance(error, BaseException):
+        return type(error).__name__
+    return error
+
+
+def is_duplicate(row):
+    return row[1] == 'skipped' and row[4] == DUPLICATE_ID
+
+
+def outcome_row(local_id, status, kind=None, email=None, error=None, response=None, thread_num=None, fingerprint=None):
+    '''
+    Row of the outcomes table for a user
+    '''
+    http_status = response.status_code if response is not None else None
+    latency = response.elapsed.total_seconds() if response is not None else None
+    error_kind = error_class(error, response) if status != 'processed' else None
+    if error is not None and not isinstance(error, str):
+        error = repr(error)
+    return (local_id, status, kind, email, error_kind, error, http_status, latency, thread_num, fingerprint)
+
+
+class RunStore:
+    '''
+    SQLite database of per-user outcomes for a run. Workers only queue rows;
+    a background thread inserts them in batches so the database never blocks a request.
+    '''
+    def __init__(self, folder_path, batch_size=500):
+        self.db_path = os.path.join(folder_path, DB_NAME)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=batch_size * 20)
+        self.thread = threading.Thread(target=self.write_outcomes, daemon=True)
+        self.thread.start()
+
+    def record(self, local_id, status, kind=None, email=None, error=None, response=None, thread_num=None, fingerprint=None):
+        self.add(outcome_row(local_id, status, kind, email, error, response, thread_num, fingerprint))
+
+    def add(self, row):
+        self.queue.put(row)
+
+    def write_outcomes(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        done = False
+        while not done:
+            rows = [self.queue.get()]
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in rows:
+                rows = [row for row in rows if row is not None]
+                done = True
+            conn.executemany(INSERT, [row for row in rows if not is_duplicate(row)])
+            conn.executemany(INSERT_DUPLICATE, [row for row in rows if is_duplicate(row)])
+            conn.commit()
+        conn.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class OutcomeSender:
+    '''
+    Stand-in for a RunStore in a worker process. Outcome rows are sent in batches over
+    `outcome_queue` to the main process, which writes them to the run's RunStore.
+    '''
+    def __init__(self, outcome_queue, batch_size=100):
+        self.outcome_queue = outcome_queue
+        self.batch_size = batch_size
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def record(self, local_id, status, kind=None, email=None, error=None, response=None, thread_num=None, fingerprint=None):
+        row = outcome_row(local_id, status, kind, email, error, response, thread_num, fingerprint)
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) < self.batch_size:
+                return
+            rows, self.rows = self.rows, []
+        self.outcome_queue.put(('outcomes', rows))
+
+    def close(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if rows:
+            self.outcome_queue.put(('outcomes', rows))
+
+
+def merge_stores(folder_path, source_folders):
+    '''
+    Copy the outcomes of every source folder's database into the database of `folder_path`
+    '''
+    conn = sqlite3.connect(os.path.join(folder_path, DB_NAME))
+    conn.executescript(SCHEMA)
+    merged = 0
+    for source_folder in source_folders:
+        source_path = os.path.join(source_folder, DB_NAME)
+        if not os.path.exists(source_path):
+            continue
+        conn.execute('ATTACH DATABASE ? AS source', (source_path,))
+        merged += conn.execute("INSERT OR REPLACE INTO outcomes SELECT * FROM source.outcomes "
+                               "WHERE NOT (status = 'skipped' AND error_class IS ?)", (DUPLICATE_ID,)).rowcount
+        merged += conn.execute("INSERT OR IGNORE INTO outcomes SELECT * FROM source.outcomes "
+                               "WHERE status = 'skipped' AND error_class IS ?", (DUPLICATE_ID,)).rowcount
+        conn.commit()
+        conn.execute('DETACH DATABASE source')
+    conn.close()
+    return merged
+
+
+def open_store(folder_path):
+    '''
+    Open the outcome database of a logs folder, or return None for runs without one
+    '''
+    db_path = os.path.join(folder_path, DB_NAME)
+    if not os.path.exists(db_path):
+        return None
+    return sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+
+
+def status_counts(conn):
+    return dict(conn.execute('SELECT status, COUNT(*) FROM outcomes GROUP BY status'))
+
+
+def breakdown(conn, status, column):
+    '''
+    (value, count) pairs of `column` for users with `status`, most common first
+    '''
+    query = f'SELECT {column}, COUNT(*) AS n FROM outcomes WHERE status = ? GROUP BY {column} ORDER BY n DESC'
+    return conn.execute(query, (status,)).fetchall()
+
+
+def samples(conn, status, column, value, limit=5):
+    '''
+    Up to `limit` outcome rows with `status` whose `column` equals `value`
+    '''
+    query = f'SELECT * FROM outcomes WHERE status = ? AND {column} IS ? LIMIT ?'
+    return [row_to_dict(row) for row in conn.execute(query, (status, value, limit))]
+
+
+def lookup(conn, local_id):
+    row = conn.execute('SELECT * FROM outcomes WHERE local_id = ?', (local_id,)).fetchone()
+    return row_to_dict(row) if row else None
+
+
+def ids_with_status(conn, statuses):
+    '''
+    localIds of the users whose outcome is one of `statuses`
+    '''
+    query = f'SELECT local_id FROM outcomes WHERE status IN ({", ".join("?" * len(statuses))})'
+    return [row[0] for row in conn.execute(query, statuses)]
+
+
+def processed_fingerprint(conn, local_id):
+    '''
+    Fingerprint recorded for a user the run migrated, or None
+    '''
+    row = conn.execute("SELECT fingerprint FROM outcomes WHERE local_id = ? AND status = 'processed'", (local_id,)).fetchone()
+    return row[0] if row else None
+
+
+def row_to_dict(row):
+    columns = ['local_id', 'status', 'kind', 'email', 'error_class', 'error', 'http_status', 'latency', 'thread', 'fingerprint']
+    return dict(zip(columns, row))
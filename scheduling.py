@@ -0,0 +1,146 @@
+import collections
+import heapq
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from user_stream import write_record
+
+# Scheduling modes: dump order, most recently active first, or activity tiers in turn
+DUMP_ORDER = 'dump'
+ACTIVITY = 'activity'
+TIERS = 'tiers'
+SCHEDULES = (DUMP_ORDER, ACTIVITY, TIERS)
+
+# Activity tiers in the order they are migrated
+TIER_NAMES = ('active', 'recent', 'dormant')
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def last_activity(user):
+    '''
+    Milliseconds timestamp of a user's last sign-in, else of its creation, else 0
+    '''
+    try:
+        return int(user.get('lastSignedInAt') or user.get('createdAt') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def tier_of(user, now_ms, active_days, recent_days):
+    age = now_ms - last_activity(user)
+    if age <= active_days * DAY_MS:
+        return 'active'
+    if age <= recent_days * DAY_MS:
+        return 'recent'
+    return 'dormant'
+
+
+def _read_spill(file_path):
+    with open(file_path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _write_spill(file_path, users):
+    with open(file_path, 'w') as f:
+        for user in users:
+            write_record(f, user)
+
+
+class Scheduler:
+    '''
+    Reorders a stream of users so recently active users are migrated first.
+    The whole input is read before the first user is yielded; users beyond
+    `buffer_size` are spilled to sorted NDJSON runs in a temporary folder and
+    merged back, so memory stays bounded however large the dump is.
+    '''
+    def __init__(self, mode, buffer_size=100000, temp_dir=None, active_days=30, recent_days=365):
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        self.active_days = active_days
+        self.recent_days = recent_days
+        # Users per tier of the last scheduled stream
+        self.tiers = collections.Counter()
+        self.now_ms = 0
+
+    def schedule(self, users):
+        self.now_ms = time.time() * 1000
+        if self.mode == ACTIVITY:
+            return self.announce(self.by_activity(users))
+        if self.mode == TIERS:
+            return self.announce(self.by_tier(users))
+        return users
+
+    def tier(self, user):
+        return tier_of(user, self.now_ms, self.active_days, self.recent_days)
+
+    def count_tiers(self, users):
+        for user in users:
+            self.tiers[self.tier(user)] += 1
+            yield user
+
+    def announce(self, users):
+        '''
+        Print when every user of a tier has been handed to the workers
+        '''
+        current = None
+        for user in users:
+            name = self.tier(user)
+            if name != current:
+                if current:
+                    print(f'Scheduling: all {self.tiers[current]} {current} users queued')
+                current = name
+            yield user
+        if current:
+            print(f'Scheduling: all {self.tiers[current]} {current} users queued')
+
+    def by_activity(self, users):
+        '''
+        Yield users from the most to the least recently active, with an external merge sort
+        '''
+        folder = tempfile.mkdtemp(prefix='fb2kc-schedule-', dir=self.temp_dir)
+        try:
+            users = self.count_tiers(users)
+            runs = []
+            while True:
+                buffer = list(itertools.islice(users, self.buffer_size))
+                if not buffer:
+                    break
+                # sort is stable, so users with the same activity keep their dump order
+                buffer.sort(key=last_activity, reverse=True)
+                if not runs and len(buffer) < self.buffer_size:
+                    # The whole input fits in memory
+                    yield from buffer
+                    return
+                run_path = os.path.join(folder, f'run_{len(runs)}.ndjson')
+                _write_spill(run_path, buffer)
+                runs.append(run_path)
+            yield from heapq.merge(*(_read_spill(run_path) for run_path in runs), key=last_activity, reverse=True)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def by_tier(self, users):
+        '''
+        Yield the active, recent and dormant users in turn, each tier in dump order
+        '''
+        folder = tempfile.mkdtemp(prefix='fb2kc-schedule-', dir=self.temp_dir)
+        try:
+            files = {name: open(os.path.join(folder, f'{name}.ndjson'), 'w') for name in TIER_NAMES}
+            try:
+                for user in users:
+                    name = self.tier(user)
+                    self.tiers[name] += 1
+                    write_record(files[name], user)
+            finally:
+                for f in files.values():
+                    f.close()
+            for name in TIER_NAMES:
+                yield from _read_spill(os.path.join(folder, f'{name}.ndjson'))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
@@ -1,89 +1,68 @@
-import json
-import os
-import re
-import phonenumbers
+import argparse
+import multiprocessing
+import time
 
-# Regular expression for validating an email
-EMAIL_REGEX = r'^[^@]+@[^@]+\.[^@]+$'
+from user_stream import bounded_imap, iter_chunks, iter_users, open_output, write_record
+from user_validation import validate_record
 
-# Function to validate email using regular expression
-def is_valid_email(email):
-    return re.match(EMAIL_REGEX, email) is not None
-
-# Function to validate phone number using phonenumbers library
-def is_valid_phone(phone):
-    try:
-        phone_number = phonenumbers.parse(phone)
-        return phonenumbers.is_valid_number(phone_number)
-    except phonenumbers.NumberParseException:
-        return False
+# Records validated per chunk, and how often progress is printed
+CHUNK_SIZE = 10000
+PROGRESS_INTERVAL = 100000
 
 # Read the records from the JSON file
 def read_records(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        users = data['users'] if isinstance(data, dict) and 'users' in data else data
-        return users
-
-# Write records to a file
-def write_records(file_path, records):
-    with open(file_path, 'w') as file:
-        json.dump(records, file, indent=4)
+    return iter_users(file_path)
 
-# Main function to process the records
-def process_records(input_file):
-    records = read_records(input_file)
+# Validate a chunk of records, returning the valid and invalid records
+def validate_chunk(records):
     valid_records = []
     invalid_records = []
+    for record in records:
+        invalid_record = validate_record(record)
+        if invalid_record is None:
+            valid_records.append(record)
+        else:
+            invalid_records.append(invalid_record)
+    return valid_records, invalid_records
 
-    for i, record in enumerate(records):
-        print(f'Validating record no. {i+1} with id {record["localId"]}')
-
-        # Perform all checks once and store results
-        has_email = 'email' in record
-        has_phone = 'phoneNumber' in record
-        has_password = 'passwordHash' in record
-        is_email_verified = record.get('emailVerified', False)
-        email_valid = is_valid_email(record.get('email', '')) if has_email else False
-        phone_valid = is_valid_phone(record.get('phoneNumber', '')) if has_phone else False
-
-        email = record.get('email', '')
-        phone = record.get('phoneNumber', '')
-
-        email_valid = is_valid_email(email) if email else False
-        phone_valid = is_valid_phone(phone) if phone else False
+# Main function to process the records
+def process_records(input_file, num_processes=1, compress=False):
+    start_time = time.time()
+    records = read_records(input_file)
+    extension = '.ndjson.gz' if compress else '.ndjson'
+    valid_file = f'filtered_records{extension}'
+    invalid_file = f'skipped_records{extension}'
 
-        # Check if the record is valid
-        if (has_phone and phone_valid) or (has_email and has_password) or \
-            (has_email and is_email_verified):
-                if phone_valid or email_valid:
-                    valid_records.append(record)
-                    continue
-        
-        # If any of the conditions are not met, capture the reasons
-        reasons = {}
-        if has_email and has_phone:
-            if not email_valid and not phone_valid:
-                reasons['invalidEmailPhone'] = "User with invalid email and phone"
-            elif email_valid and not phone_valid and not has_password and not is_email_verified:
-                reasons['invalidPhoneUnverifiedEmailMissingPassword'] = "User with invalid phone, unverified address and missing password"
-        elif has_email and not has_phone:
-            if not has_password and not is_email_verified:
-                reasons['unverifiedEmailMissingPassword'] = "Email user with unverified address and missing password"
-        elif not has_email and has_phone and not phone_valid:
-            reasons['invalidPhone'] = "User with Invalid phone number"
-        elif not has_email and not has_phone:
-            reasons['anon'] = "Anonymous user"
-        
-        record_with_reasons = record.copy()
-        record_with_reasons['reasons'] = reasons if reasons else 'N.A.'
-        invalid_records.append(record_with_reasons)
+    total = 0
+    chunks = iter_chunks(records, CHUNK_SIZE)
+    pool = multiprocessing.Pool(num_processes) if num_processes > 1 else None
+    try:
+        # Records are written as soon as their chunk is validated
+        with open_output(valid_file) as valid_out, open_output(invalid_file) as invalid_out:
+            results = bounded_imap(pool, validate_chunk, chunks, num_processes * 2) if pool else map(validate_chunk, chunks)
+            for valid_chunk, invalid_chunk in results:
+                for record in valid_chunk:
+                    write_record(valid_out, record)
+                for record in invalid_chunk:
+                    write_record(invalid_out, record)
+                previous_total = total
+                total += len(valid_chunk) + len(invalid_chunk)
+                if total // PROGRESS_INTERVAL > previous_total // PROGRESS_INTERVAL:
+                    print(f'Validated {total} records ({total / (time.time() - start_time):.2f} records/sec)')
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-    write_records('filtered_records.json', valid_records)
-    write_records('skipped_records.json', invalid_records)
-    print(f"Valid records written to filtered_records.json")
-    print(f"Invalid records written to skipped_records.json")
+    total_time = time.time() - start_time
+    print(f"Valid records written to {valid_file}")
+    print(f"Invalid records written to {invalid_file}")
+    print(f"Validated {total} records in {total_time:.2f} seconds ({total / total_time if total_time else 0:.2f} records/sec)")
 
 if __name__ == "__main__":
-    input_file = 'LOG/users.json'
-    process_records(input_file)
+    parser = argparse.ArgumentParser(description='Split a Firebase user dump into valid and skipped records')
+    parser.add_argument('input_file', nargs='?', default='LOG/users.json')
+    parser.add_argument('--processes', type=int, default=1, help='Validate chunks of records in this many processes')
+    parser.add_argument('--gzip', action='store_true', help='Write gzip-compressed outputs')
+    args = parser.parse_args()
+    process_records(args.input_file, args.processes, args.gzip)
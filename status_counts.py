@@ -1,5 +1,8 @@
 import os
 import json
+import sys
+
+from run_store import lookup, open_store, status_counts
 
 def load_ids(file_path):
     try:
@@ -15,6 +18,13 @@ def load_ids(file_path):
         return []
 
 def count_user_statuses(folder_path):
+    # Runs with an outcome database are counted with a single query
+    conn = open_store(folder_path)
+    if conn:
+        counts = status_counts(conn)
+        conn.close()
+        return counts.get('processed', 0), counts.get('unprocessed', 0), counts.get('failed', 0), counts.get('skipped', 0)
+
     processed_count = 0
     unprocessed_count = 0
     failed_count = 0
@@ -32,12 +42,27 @@ def count_user_statuses(folder_path):
 
     return processed_count, unprocessed_count, failed_count, skipped_count
 
+def lookup_users(folder_path, local_ids):
+    conn = open_store(folder_path)
+    if not conn:
+        print("No outcome database in this logs folder, lookup by localId is not available.")
+        return
+    for local_id in local_ids:
+        outcome = lookup(conn, local_id)
+        print(json.dumps(outcome) if outcome else f"{local_id}: not found")
+    conn.close()
+
 def main():
-    folder_path = input("Enter the path to the logs folder: ")
+    # Usage: status_counts.py [LOGS_DIR [LOCAL_ID ...]]
+    folder_path = sys.argv[1] if len(sys.argv) > 1 else input("Enter the path to the logs folder: ")
     if not os.path.isdir(folder_path):
         print("Invalid folder path. Please provide a valid absolute path to the logs folder.")
         return
 
+    if len(sys.argv) > 2:
+        lookup_users(folder_path, sys.argv[2:])
+        return
+
     processed_count, unprocessed_count, failed_count, skipped_count = count_user_statuses(folder_path)
 
     print(f"Processed users count: {processed_count}")
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import re
+import uuid
+
+# Kinds of Firebase user records, as returned by classify_user
+PHONE_USER = 'phone'
+EMAIL_PASSWORD_USER = 'email-password'
+PROVIDER_USER = 'provider'
+EMAIL_USER = 'email'
+SKIPPED_PROVIDER_USER = 'skipped-provider'
+INVALID_USER = 'invalid'
+
+SKIPPED_KINDS = (SKIPPED_PROVIDER_USER, INVALID_USER)
+
+# Separates routing metadata from the serialized payload in a compiled line
+COMPILED_PAYLOAD_KEY = ', "payload": '
+
+
+def classify_user(user):
+    '''
+    Decide how a Firebase user record is migrated
+    '''
+    # Note: Duplicate phone user is not handled unless it used as username
+    if 'phoneNumber' in user and 'passwordHash' not in user:
+        return PHONE_USER
+    elif 'email' in user and 'passwordHash' in user:
+        return EMAIL_PASSWORD_USER
+    elif 'providerUserInfo' in user and len(user['providerUserInfo']) > 0:
+        # Records with 'facebookProvider' will be processed without adding facebook provider
+        for provider in user['providerUserInfo']:
+            if provider['providerId'] in ['google.com', 'facebook.com']:
+                return PROVIDER_USER
+        return SKIPPED_PROVIDER_USER
+    elif 'email' in user:
+        return EMAIL_USER
+    return INVALID_USER
+
+
+def fingerprint(user):
+    '''
+    Digest of the fields of a Firebase user that the migration carries to Keycloak,
+    used to tell whether the user changed between two exports
+    '''
+    providers = sorted(
+        (provider.get('providerId'), provider.get('rawId'), provider.get('email'))
+        for provider in user.get('providerUserInfo', [])
+    )
+    content = [
+        user.get('passwordHash'), user.get('salt'), user.get('email'), user.get('emailVerified', False),
+        user.get('phoneNumber'), user.get('disabled', False), providers,
+    ]
+    return hashlib.blake2b(json.dumps(content).encode(), digest_size=16).hexdigest()
+
+
+def get_display_name(user):
+    '''
+    Helper function to get display name from user data.
+    Falls back to email or phone number if display name is not available.
+    '''
+    if user.get('displayName'):
+        unicode_text = user['displayName']
+        safe_text = re.sub(r'\\u[0-9A-Fa-f]{0,3}(?![0-9A-Fa-f])', '', unicode_text)
+        converted_text = bytes(safe_text, 'utf-8').decode('unicode-escape')
+        return converted_text.split(' ')
+    elif user.get('email'):
+        email_name = user['email'].split('@')[0]
+        return email_name.split('.')
+    elif user.get('phoneNumber'):
+        phone_name = user['phoneNumber'].replace('+', '').replace(' ', '')
+        return [phone_name]
+    else:
+        return []
+
+
+def build_phone_number_user_data(user):
+    '''
+    Build Keycloak user representation for phone user
+    '''
+    local_id = user['localId']
+    display_name = get_display_name(user)
+    first_name = display_name[0] if display_name else None
+    last_name = display_name[1] if len(display_name) > 1 else None
+    photo_url = user.get('photoUrl', '')
+    user_data = {
+        'username': str(uuid.uuid4()),
+        'firstName': first_name,
+        'lastName': last_name,
+        'email': user.get('email', ''),
+        'emailVerified': user.get('emailVerified', False),
+        'enabled': not user.get('disabled', False),
+        'attributes': {
+            'phoneNumber': user['phoneNumber'],
+            'phoneNumberVerified': True,
+            'userId': local_id,
+        },
+    }
+    if photo_url:
+        user_data['attributes']['photoUrl'] = photo_url
+    return user_data
+
+
+def build_email_user_data(user):
+    '''
+    Build Keycloak user representation for email user
+    '''
+    local_id = user['localId']
+    display_name = get_display_name(user)
+    first_name = display_name[0] if display_name else None
+    last_name = display_name[1] if len(display_name) > 1 else None
+    photo_url = user.get('photoUrl', '')
+
+    user_data = {
+        'username': str(uuid.uuid4()),
+        'email': user['email'],
+        'emailVerified': user['emailVerified'],
+        'enabled': True,
+        'firstName': first_name,
+        'lastName': last_name,
+        'attributes': {
+            'phoneNumber': user.get('phoneNumber'),
+            'phoneNumberVerified': user.get('phoneNumberVerified', False),
+            'userId': local_id,
+        }
+    }
+
+    if 'passwordHash' in user:
+        user_data['credentials'] = [{
+            "hashedSaltedValue": user['passwordHash'],
+            "salt": user['salt'],
+            "hashIterations": -1,
+            "algorithm": "firebase-scrypt",
+            "temporary": False,
+            "type": "password"
+            }]
+        user_data['enabled'] = not user.get('disabled', False)
+
+    if photo_url:
+        user_data['attributes']['photoUrl'] = photo_url
+    return user_data
+
+
+def build_provider_user_data(user):
+    '''
+    Build Keycloak user representation for provider user i.e. user with Social Login
+    '''
+    local_id = user['localId']
+    display_name = get_display_name(user)
+    first_name = display_name[0] if display_name else None
+    last_name = display_name[1] if len(display_name) > 1 else None
+
+    user_data = {
+        'username': str(uuid.uuid4()),
+        'email': user.get('email'),
+        'emailVerified': user.get('emailVerified', False),
+        'firstName': first_name,
+        'lastName': last_name,
+        'enabled': not user.get('disabled', False),
+        'attributes': {
+            'phoneNumber': user.get('phoneNumber'),
+            'phoneNumberVerified': user.get('phoneNumberVerified', False),
+            'userId': local_id,
+            'photoUrl': user.get('photoUrl', '')
+        },
+    }
+    return user_data
+
+
+def build_federated_identities(user):
+    '''
+    Build Google federated identity links for provider user
+    '''
+    identities = []
+    for provider in user['providerUserInfo']:
+        if provider['providerId'] == 'google.com':
+            identities.append({
+                'identityProvider': 'google',
+                'userId': provider['rawId'],
+                'userName': provider['email'] if 'email' in provider else provider['displayName'],
+            })
+    return identities
+
+
+def with_identities(user_data, identities):
+    '''
+    Add federated identity links to a Keycloak user representation, given as a dict or
+    as the serialized payload of a compiled user, so the user is linked as it is created
+    '''
+    if isinstance(user_data, str):
+        return user_data[:-1] + ', "federatedIdentities": ' + json.dumps(identities) + '}'
+    return dict(user_data, federatedIdentities=identities)
+
+
+def build_user_data(user, kind):
+    '''
+    Build Keycloak user representation for a user of the given kind
+    '''
+    if kind == PHONE_USER:
+        return build_phone_number_user_data(user)
+    elif kind == PROVIDER_USER:
+        return build_provider_user_data(user)
+    elif kind in (EMAIL_PASSWORD_USER, EMAIL_USER):
+        return build_email_user_data(user)
+    raise ValueError(f'Cannot build user data for {kind} user')
+
+
+def compile_record(user):
+    '''
+    Routing metadata of a user with its ready-to-send Keycloak payload, serialized, under 'payload'
+    '''
+    kind = classify_user(user)
+    record = {'localId': user['localId'], 'kind': kind, 'email': user.get('email'), 'phoneNumber': user.get('phoneNumber'),
+              'fingerprint': fingerprint(user), 'lastSignedInAt': user.get('lastSignedInAt'), 'createdAt': user.get('createdAt')}
+    if kind == PROVIDER_USER:
+        record['identities'] = build_federated_identities(user)
+    record['payload'] = 'null' if kind in SKIPPED_KINDS else json.dumps(build_user_data(user, kind))
+    return record
+
+
+def compile_user(user):
+    '''
+    Serialize a user as one NDJSON line: routing metadata followed by the ready-to-send
+    Keycloak payload, which is kept last so it can be sliced out without parsing it
+    '''
+    record = compile_record(user)
+    payload = record.pop('payload')
+    return json.dumps(record)[:-1] + COMPILED_PAYLOAD_KEY + payload + '}\n'
+
+
+def parse_compiled(line):
+    '''
+    Read the metadata of a compiled line, with the serialized payload as a string under 'payload'
+    '''
+    index = line.index(COMPILED_PAYLOAD_KEY)
+    record = json.loads(line[:index] + '}')
+    record['payload'] = line[index + len(COMPILED_PAYLOAD_KEY):].rstrip()[:-1]
+    return record
@@ -0,0 +1,243 @@
+import collections
+import gzip
+import hashlib
+import itertools
+import json
+import zlib
+
+# Number of characters read from the dump per refill of the parser buffer
+READ_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+# Files with these extensions (optionally followed by .gz) hold one record per line
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+
+def is_ndjson(file_path):
+    '''
+    Whether a file holds one JSON record per line, judged by its extension
+    '''
+    if file_path.endswith('.gz'):
+        file_path = file_path[:-len('.gz')]
+    return file_path.endswith(NDJSON_EXTENSIONS)
+
+
+def open_output(file_path):
+    '''
+    Open a file for writing text, gzip-compressed when the path ends with .gz
+    '''
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'wt', encoding='utf-8')
+    return open(file_path, 'w', encoding='utf-8')
+
+
+def write_record(f, record):
+    '''
+    Append one record to an NDJSON file
+    '''
+    f.write(json.dumps(record))
+    f.write('\n')
+
+
+def open_dump(file_path):
+    '''
+    Open a user dump for reading text, transparently handling gzip-compressed files
+    '''
+    with open(file_path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(file_path, 'rt', encoding='utf-8')
+    return open(file_path, 'r', encoding='utf-8')
+
+
+class _Reader:
+    '''
+    Buffered character reader used to decode one JSON value at a time
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        # Characters dropped from the buffer so far, and the span of the last value
+        self.base = 0
+        self.start = self.end = 0
+
+    def fill(self):
+        # Drop consumed characters before growing the buffer
+        if self.pos:
+            self.base += self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(READ_SIZE)
+        if chunk:
+            self.buf += chunk
+        else:
+            self.eof = True
+
+    def peek(self):
+        '''
+        Return the next non-whitespace character without consuming it ('' at end of file)
+        '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Malformed user dump, expected {char!r} but found {self.peek()!r}')
+        self.pos += 1
+
+    def value(self):
+        '''
+        Decode the next JSON value, reading more of the file until it is complete
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A value ending exactly at the buffer end may be a truncated number
+                if end < len(self.buf) or self.eof:
+                    self.start, self.end = self.base + self.pos, self.base + end
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def _iter_array(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        char = reader.peek()
+        reader.pos += 1
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError(f'Malformed user array, unexpected {char!r}')
+
+
+def iter_users(file_path):
+    '''
+    Yield user records one at a time from a Firebase dump.
+    Supports the `{"users": [...]}` export layout, a bare array of users and
+    NDJSON files, optionally gzip-compressed. Only one record is held in memory at a time.
+    '''
+    if is_ndjson(file_path):
+        with open_dump(file_path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    with open_dump(file_path) as f:
+        yield from _iter_dump(_Reader(f))
+
+
+def _iter_dump(reader):
+    first = reader.peek()
+    if first == '[':
+        yield from _iter_array(reader)
+    elif first == '{':
+        reader.pos += 1
+        while reader.peek() not in ('}', ''):
+            key = reader.value()
+            reader.expect(':')
+            if key == 'users':
+                yield from _iter_array(reader)
+            else:
+                # Skip unrelated top-level keys
+                reader.value()
+            if reader.peek() == ',':
+                reader.pos += 1
+    elif first:
+        raise ValueError(f'Unsupported user dump format, starts with {first!r}')
+
+
+def iter_spans(file_path):
+    '''
+    Yield (localId, byte offset, byte length) of every user record in an uncompressed dump.
+    The JSON layouts are decoded as latin-1, which maps every byte to one character,
+    so the reader's character positions are the byte offsets in the file.
+    '''
+    with open(file_path, 'rb') as f:
+        if f.read(2) == b'\x1f\x8b':
+            raise ValueError(f'{file_path} is gzip-compressed, records can only be located in an uncompressed dump')
+
+    if is_ndjson(file_path):
+        with open(file_path, 'rb') as f:
+            offset = 0
+            for line in f:
+                local_id = json.loads(line).get('localId') if line.strip() else None
+                if local_id:
+                    yield local_id, offset, len(line.rstrip(b'\r\n'))
+                offset += len(line)
+        return
+
+    # newline='' keeps line endings untranslated so positions stay byte-exact
+    with open(file_path, 'r', encoding='latin-1', newline='') as f:
+        reader = _Reader(f)
+        for user in _iter_dump(reader):
+            # Records without a localId cannot be looked up
+            if user.get('localId'):
+                # Undo the latin-1 decoding of non-ASCII ids
+                local_id = user['localId'].encode('latin-1').decode('utf-8')
+                yield local_id, reader.start, reader.end - reader.start
+
+
+def shard_of(local_id, shard_count):
+    '''
+    0-based shard of a user, stable across processes and machines
+    '''
+    return zlib.crc32(local_id.encode()) % shard_count
+
+
+def worker_of(local_id, worker_count):
+    '''
+    0-based worker process of a user. Uses another digest than `shard_of`, so the users
+    of one shard spread over every worker whatever the shard and worker counts.
+    '''
+    return int.from_bytes(hashlib.md5(local_id.encode()).digest()[:4], 'big') % worker_count
+
+
+def iter_shard(records, shard_index, shard_count):
+    '''
+    Records whose localId falls in shard `shard_index` (0-based) of `shard_count`
+    '''
+    return (record for record in records if shard_of(record['localId'], shard_count) == shard_index)
+
+
+def iter_chunks(records, chunk_size):
+    '''
+    Group an iterable of records into lists of up to `chunk_size` records
+    '''
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bounded_imap(pool, func, iterable, window):
+    '''
+    Like `pool.imap`, but reads at most `window` items ahead of the results,
+    so memory stays bounded however large the input is
+    '''
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,60 @@
+import functools
+import re
+
+import phonenumbers
+
+# Regular expression for validating an email
+EMAIL_REGEX = r'^[^@]+@[^@]+\.[^@]+$'
+
+# Function to validate email using regular expression
+def is_valid_email(email):
+    return re.match(EMAIL_REGEX, email) is not None
+
+# Function to validate phone number using phonenumbers library.
+# Results are cached since the same numbers recur across a dump.
+@functools.lru_cache(maxsize=1 << 16)
+def is_valid_phone(phone):
+    try:
+        phone_number = phonenumbers.parse(phone)
+        return phonenumbers.is_valid_number(phone_number)
+    except phonenumbers.NumberParseException:
+        return False
+
+# Validate a single record, returning None if valid or a copy with the reasons it was skipped
+def validate_record(record):
+    # Perform all checks once and store results
+    has_email = 'email' in record
+    has_phone = 'phoneNumber' in record
+    has_password = 'passwordHash' in record
+    is_email_verified = record.get('emailVerified', False)
+
+    email = record.get('email', '')
+    phone = record.get('phoneNumber', '')
+
+    email_valid = is_valid_email(email) if email else False
+    phone_valid = is_valid_phone(phone) if phone else False
+
+    # Check if the record is valid
+    if (has_phone and phone_valid) or (has_email and has_password) or \
+        (has_email and is_email_verified):
+            if phone_valid or email_valid:
+                return None
+
+    # If any of the conditions are not met, capture the reasons
+    reasons = {}
+    if has_email and has_phone:
+        if not email_valid and not phone_valid:
+            reasons['invalidEmailPhone'] = "User with invalid email and phone"
+        elif email_valid and not phone_valid and not has_password and not is_email_verified:
+            reasons['invalidPhoneUnverifiedEmailMissingPassword'] = "User with invalid phone, unverified address and missing password"
+    elif has_email and not has_phone:
+        if not has_password and not is_email_verified:
+            reasons['unverifiedEmailMissingPassword'] = "Email user with unverified address and missing password"
+    elif not has_email and has_phone and not phone_valid:
+        reasons['invalidPhone'] = "User with Invalid phone number"
+    elif not has_email and not has_phone:
+        reasons['anon'] = "Anonymous user"
+
+    record_with_reasons = record.copy()
+    record_with_reasons['reasons'] = reasons if reasons else 'N.A.'
+    return record_with_reasons
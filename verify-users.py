@@ -0,0 +1,169 @@
+import argparse, collections, dotenv, json, os, time
+from concurrent.futures import ThreadPoolExecutor
+
+from keycloak_client import AdaptiveController, admin_get, create_session, create_token_manager, iter_user_pages
+from preflight import normalize_email
+from user_payloads import PROVIDER_USER, SKIPPED_KINDS, build_federated_identities, build_user_data, classify_user
+from user_stream import iter_users
+
+# Load environment variables
+dotenv.load_dotenv()
+
+KEYCLOAK_URL = os.getenv('KEYCLOAK_URL')
+REALM_NAME = os.getenv('REALM_NAME')
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+VERIFY_PAGE_SIZE = int(os.getenv('VERIFY_PAGE_SIZE', '1000'))  # Keycloak users per page while indexing the realm
+VERIFY_WORKERS = int(os.getenv('VERIFY_WORKERS', '8'))  # Concurrent Keycloak requests
+LATENCY_TARGET = float(os.getenv('LATENCY_TARGET', '2.0'))  # Seconds; slower responses reduce concurrency
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '5'))  # Retries for 429/5xx responses and connection errors
+# (connect, read) timeouts in seconds for Keycloak requests
+REQUEST_TIMEOUT = (float(os.getenv('CONNECT_TIMEOUT', '10')), float(os.getenv('READ_TIMEOUT', '60')))
+
+# Fields compared between the dump and Keycloak
+KeycloakUser = collections.namedtuple('KeycloakUser', ['id', 'email', 'enabled', 'phone_number', 'identities'])
+
+def attribute(user, name):
+    '''
+    First value of a Keycloak user attribute, which Keycloak returns as a list
+    '''
+    values = (user.get('attributes') or {}).get(name) or [None]
+    return values[0] if isinstance(values, list) else values
+
+def index_realm(pages):
+    '''
+    Index pages of Keycloak users by their `userId` attribute. Returns the index,
+    {userId: [KeycloakUser, ...]}, and the number of Keycloak users without a userId.
+    '''
+    index = {}
+    without_id = 0
+    for page in pages:
+        for user in page:
+            user_id = attribute(user, 'userId')
+            if not user_id:
+                without_id += 1
+                continue
+            identities = user.get('federatedIdentities')
+            if identities is not None:
+                identities = {identity['identityProvider']: identity['userId'] for identity in identities}
+            index.setdefault(user_id, []).append(KeycloakUser(
+                user['id'], normalize_email(user.get('email')), user.get('enabled'),
+                attribute(user, 'phoneNumber') or None, identities))
+    return index, without_id
+
+def compare(user, kind, keycloak_user):
+    '''
+    Differences between the user Keycloak should hold for a dump record and the one it holds
+    '''
+    expected = build_user_data(user, kind)
+    differences = {}
+    email = normalize_email(expected.get('email'))
+    if email != keycloak_user.email:
+        differences['email'] = [email, keycloak_user.email]
+    if expected['enabled'] != keycloak_user.enabled:
+        differences['enabled'] = [expected['enabled'], keycloak_user.enabled]
+    phone_number = expected['attributes'].get('phoneNumber') or None
+    if phone_number != keycloak_user.phone_number:
+        differences['phoneNumber'] = [phone_number, keycloak_user.phone_number]
+    return differences
+
+def compare_identities(expected, linked):
+    '''
+    Google identities of the dump missing from, or linked to another account in, Keycloak
+    '''
+    return {
+        identity['identityProvider']: [identity['userId'], linked.get(identity['identityProvider'])]
+        for identity in expected
+        if linked.get(identity['identityProvider']) != identity['userId']
+    }
+
+def verify_users(user_dump, report_path, check_identities):
+    start_time = time.time()
+    users_url = f'{KEYCLOAK_URL}/admin/realms/{REALM_NAME}/users'
+    tokens = create_token_manager(KEYCLOAK_URL, REALM_NAME, os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'), ADMIN_TOKEN, REQUEST_TIMEOUT)
+    controller = AdaptiveController(VERIFY_WORKERS, VERIFY_WORKERS, LATENCY_TARGET, MAX_RETRIES, 0.5, 30)
+    session = create_session(VERIFY_WORKERS)
+    get = admin_get(session, controller, tokens, REQUEST_TIMEOUT)
+
+    index, without_id = index_realm(iter_user_pages(get, users_url, VERIFY_PAGE_SIZE, VERIFY_WORKERS))
+    print(f'Indexed {sum(len(found) for found in index.values())} Keycloak users in {time.time() - start_time:.2f} seconds, '
+          f'{without_id} without a userId')
+
+    counts = collections.Counter()
+    # Provider users whose identities are not part of the user listing, checked afterwards
+    identity_checks = []
+    with open(report_path, 'w') as report:
+        def problem(local_id, kind, status, **details):
+            counts[status] += 1
+            report.write(json.dumps(dict(localId=local_id, kind=kind, problem=status, **details)) + '\n')
+
+        def finish(local_id, kind, keycloak_user, differences, duplicated):
+            if differences:
+                problem(local_id, kind, 'mismatched', keycloakId=keycloak_user.id, differences=differences)
+            elif not duplicated:
+                counts['ok'] += 1
+
+        checked = set()
+        for user in iter_users(user_dump):
+            local_id = user.get('localId')
+            if not local_id or local_id in checked:
+                continue
+            checked.add(local_id)
+            kind = classify_user(user)
+            found = index.pop(local_id, [])
+            if kind in SKIPPED_KINDS:
+                # Invalid records are never migrated
+                counts['not migrated'] += 1
+                if found:
+                    problem(local_id, kind, 'unexpected', keycloakIds=[keycloak_user.id for keycloak_user in found])
+                continue
+            if not found:
+                problem(local_id, kind, 'missing')
+                continue
+            duplicated = len(found) > 1
+            if duplicated:
+                problem(local_id, kind, 'duplicated', keycloakIds=[keycloak_user.id for keycloak_user in found])
+            keycloak_user = found[0]
+            differences = compare(user, kind, keycloak_user)
+            if kind == PROVIDER_USER:
+                expected = build_federated_identities(user)
+                if keycloak_user.identities is not None:
+                    differences.update(compare_identities(expected, keycloak_user.identities))
+                elif check_identities:
+                    identity_checks.append((local_id, keycloak_user, differences, duplicated, expected))
+                    continue
+            finish(local_id, kind, keycloak_user, differences, duplicated)
+
+        if identity_checks:
+            def fetch_identities(check):
+                response = get(f'{users_url}/{check[1].id}/federated-identity')
+                response.raise_for_status()
+                return {identity['identityProvider']: identity['userId'] for identity in response.json()}
+            with ThreadPoolExecutor(VERIFY_WORKERS) as pool:
+                for check, linked in zip(identity_checks, pool.map(fetch_identities, identity_checks)):
+                    local_id, keycloak_user, differences, duplicated, expected = check
+                    differences.update(compare_identities(expected, linked))
+                    finish(local_id, PROVIDER_USER, keycloak_user, differences, duplicated)
+
+        # Keycloak users whose userId is not in the dump
+        for local_id, found in index.items():
+            problem(local_id, None, 'unknown', keycloakIds=[keycloak_user.id for keycloak_user in found])
+
+    session.close()
+    total_time = time.time() - start_time
+    print(f'Checked {len(checked)} dump users against Keycloak')
+    for status in ('ok', 'missing', 'duplicated', 'mismatched', 'unknown', 'unexpected', 'not migrated'):
+        print(f'- {status}: {counts[status]}')
+    print(f'Problems written to {report_path}')
+    print(f'Total time taken: {total_time:.2f} seconds ({len(checked) / total_time if total_time else 0:.2f} users/sec)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile a Firebase user dump with the users in Keycloak')
+    parser.add_argument('--dump', default=os.getenv('USER_DUMP_FILE'), help='Firebase user dump (default: USER_DUMP_FILE)')
+    parser.add_argument('--output', default='verify_report.ndjson', help='NDJSON file listing every user with a problem')
+    parser.add_argument('--identities', action='store_true',
+                        help='Also fetch the linked identities of Google users, one request per provider user')
+    args = parser.parse_args()
+    verify_users(args.dump, args.output, args.identities)
+
+if __name__ == "__main__":
+    main()